@@ -0,0 +1,184 @@
+# benchmarks/bench_broadcast.py — рассылка через FakeSession: скорость, соблюдение лимита, продолжение после остановки
+#
+#   BENCH_DATABASE_URL=postgresql://postgres@localhost:5432/bench \
+#       python -m benchmarks.bench_broadcast --users 3000 --rate 100 --flood-every 500 --interrupt-at 0.5
+#
+# Telegram заменён FakeSession (задержка вызова, TelegramRetryAfter на каждый N-й вызов,
+# часть пользователей заблокировала бота), БД — настоящий Postgres. С --interrupt-at
+# рассылка останавливается на этой доле получателей и продолжается новым Broadcaster:
+# проверяется, что никто не потерян, и считаются повторы. Пользователи и рассылка
+# бенчмарка удаляются после прогона.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from bisect import bisect_left
+
+from aiogram import Bot
+
+from benchmarks.fake_telegram import FakeSession
+from broadcast import Broadcaster
+from database import Database
+from migrations import migrate
+
+BENCH_TELEGRAM_BASE = 9_300_000_000
+BENCH_CHAT_ID = -BENCH_TELEGRAM_BASE  # чат «администратора»: по нему находим рассылки бенчмарка
+
+
+async def seed(db, users):
+    await cleanup(db)
+    async with db.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO users (telegram_id, first_name)
+            SELECT $1::bigint + g, 'Bench' FROM generate_series(0, $2 - 1) g
+        ''', BENCH_TELEGRAM_BASE, users)
+        await conn.execute('ANALYZE users')
+
+
+async def cleanup(db):
+    async with db.acquire() as conn:
+        await conn.execute('DELETE FROM broadcasts WHERE chat_id = $1', BENCH_CHAT_ID)
+        await conn.execute('DELETE FROM users WHERE telegram_id >= $1', BENCH_TELEGRAM_BASE)
+
+
+def max_per_second(times):
+    """Наибольшее число отправок в любом окне длиной 1 с"""
+    times = sorted(times)
+    return max((n - bisect_left(times, t - 1.0) + 1 for n, t in enumerate(times)), default=0)
+
+
+async def run_phase(db, bot, args, stop_at=None):
+    """Прогон Broadcaster до конца рассылки или до stop_at обработанных получателей"""
+    finished = asyncio.Event()
+
+    async def on_progress(progress):
+        print(json.dumps(progress), file=sys.stderr)
+        if progress['state'] != 'running':
+            finished.set()
+
+    broadcaster = Broadcaster(
+        db, bot,
+        rate=args.rate,
+        workers=args.workers,
+        segment=args.segment,
+        lease=args.lease,
+        checkpoint_interval=args.checkpoint_interval,
+        report_interval=1.0,
+        poll_interval=0.2,
+        on_progress=on_progress
+    )
+    broadcaster.start()
+    try:
+        while not finished.is_set():
+            run = broadcaster.current
+            if stop_at and run and run.processed >= stop_at:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await broadcaster.stop()
+    return broadcaster.retry_afters
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылки")
+    parser.add_argument("--users", type=int, default=3000)
+    parser.add_argument("--rate", type=float, default=100, help="сообщений в секунду")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--segment", type=int, default=1000, help="получателей на один курсор")
+    parser.add_argument("--latency-ms", type=float, default=30, help="задержка вызова Bot API")
+    parser.add_argument("--flood-every", type=int, default=0, help="TelegramRetryAfter на каждый N-й вызов")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked", type=float, default=0.02, help="доля заблокировавших бота")
+    parser.add_argument("--interrupt-at", type=float, default=0.5,
+                        help="доля получателей, после которой рассылка останавливается и продолжается (0 — без остановки)")
+    parser.add_argument("--lease", type=int, default=30)
+    parser.add_argument("--checkpoint-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    dsn = os.getenv("BENCH_DATABASE_URL")
+    if not dsn:
+        sys.exit("BENCH_DATABASE_URL должна быть задана")
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+
+    os.environ["DATABASE_URL"] = dsn
+    os.environ.pop("DATABASE_REPLICA_URL", None)
+    db = Database(user_cache_size=0)
+    await db.connect()
+    await migrate(db)
+
+    blocked = {
+        BENCH_TELEGRAM_BASE + n for n in random.sample(range(args.users), int(args.users * args.blocked))
+    }
+    session = FakeSession(
+        latency=args.latency_ms / 1000, flood_every=args.flood_every, retry_after=args.retry_after,
+        blocked=blocked
+    )
+    bot = Bot("42:BENCH", session=session)
+
+    try:
+        await seed(db, args.users)
+        broadcast = await db.create_broadcast("📣 bench", BENCH_CHAT_ID)
+        await db.start_broadcast(broadcast['id'])
+
+        started = time.perf_counter()
+        retry_afters = 0
+        phases = 0
+        stop_at = int(broadcast['total'] * args.interrupt_at) if args.interrupt_at else None
+        while True:
+            phases += 1
+            retry_afters += await run_phase(db, bot, args, stop_at if phases == 1 else None)
+            async with db.acquire() as conn:
+                row = await conn.fetchrow('SELECT * FROM broadcasts WHERE id = $1', broadcast['id'])
+            if row['state'] != 'running':
+                break
+        elapsed = time.perf_counter() - started
+
+        async with db.acquire() as conn:
+            marked = await conn.fetchval(
+                'SELECT count(*) FROM users WHERE telegram_id >= $1 AND blocked_at IS NOT NULL',
+                BENCH_TELEGRAM_BASE
+            )
+    finally:
+        await cleanup(db)
+        await db.close()
+
+    bench_chats = range(BENCH_TELEGRAM_BASE, BENCH_TELEGRAM_BASE + args.users)
+    sends = [t for chat_id in bench_chats for name, t in session.sent.get(chat_id, ()) if name == "SendMessage"]
+    counts = [len(session.sent.get(chat_id, ())) for chat_id in bench_chats if chat_id not in blocked]
+    report = json.dumps({
+        "benchmark": "broadcast",
+        "users": args.users,
+        "rate": args.rate,
+        "workers": args.workers,
+        "latency_ms": args.latency_ms,
+        "flood_every": args.flood_every,
+        "interrupt_at": args.interrupt_at,
+        "state": row['state'],
+        "phases": phases,
+        "seconds": round(elapsed, 2),
+        "total": row['total'],
+        "delivered": row['delivered'],
+        "blocked": row['blocked'],
+        "failed": row['failed'],
+        "blocked_marked": marked,
+        "delivered_per_sec": round(row['delivered'] / elapsed, 1),
+        "max_sends_per_sec": max_per_second(sends),
+        "retry_afters": retry_afters,
+        "duplicates": sum(count - 1 for count in counts if count > 1),
+        "missing": sum(1 for count in counts if count == 0),
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+# benchmarks/bench_imaging.py — пропускная способность постобработки (превью в пуле процессов)
+#
+#   python -m benchmarks.bench_imaging --images 200 --workers 1 2 4 --format webp
+#
+# Исходник — синтетическое изображение с шумом (плохо сжимается, как настоящие
+# генерации). Параллельно event loop тикает каждые 10 мс: задержка тиков
+# показывает, блокирует ли обработка цикл.
+import argparse
+import asyncio
+import io
+import json
+import sys
+import time
+
+from imaging import ImagePipeline, available_cores
+
+
+def make_source(size, fmt):
+    from PIL import Image
+
+    noise = Image.effect_noise((size, size), 64)
+    gradient = Image.linear_gradient("L").resize((size, size))
+    image = Image.merge("RGB", (noise, gradient, gradient.transpose(Image.Transpose.ROTATE_90)))
+    out = io.BytesIO()
+    image.save(out, fmt.upper())
+    return out.getvalue()
+
+
+async def run_once(data, images, workers, cores, max_side, quality):
+    pipeline = ImagePipeline(workers=workers, max_side=max_side, quality=quality)
+    await pipeline.start()
+    if not pipeline.enabled:
+        sys.exit("Pillow не установлен")
+
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    results = await asyncio.gather(*(pipeline.preview(data) for _ in range(images)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+    await pipeline.stop()
+
+    per_sec = images / elapsed
+    return {
+        "workers": workers,
+        "images": images,
+        "seconds": round(elapsed, 3),
+        "images_per_sec": round(per_sec, 1),
+        "images_per_sec_per_core": round(per_sec / min(workers, cores), 1),
+        "preview_bytes": len(results[0][0]),
+        "loop_lag_max_ms": round(max(lags) * 1000, 2) if lags else None,
+    }
+
+
+async def main():
+    cores = available_cores()
+    parser = argparse.ArgumentParser(description="Бенчмарк постобработки изображений")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, cores}))
+    parser.add_argument("--size", type=int, default=1024, help="сторона исходного изображения")
+    parser.add_argument("--format", default="webp", help="формат исходника (webp, png, jpeg)")
+    parser.add_argument("--max-side", type=int, default=1280)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    data = make_source(args.size, args.format)
+    results = []
+    for workers in args.workers:
+        results.append(await run_once(data, args.images, workers, cores, args.max_side, args.quality))
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    report = json.dumps({
+        "benchmark": "imaging",
+        "cores": cores,
+        "source_bytes": len(data),
+        "source": f"{args.size}x{args.size} {args.format}",
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
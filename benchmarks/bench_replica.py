@@ -0,0 +1,164 @@
+# benchmarks/bench_replica.py — смешанная нагрузка: один пул против пулов основного сервера и реплики
+#
+#   BENCH_DATABASE_URL=postgresql://postgres@localhost:5432/bench \
+#   BENCH_REPLICA_URL=postgresql://postgres@localhost:5433/bench \
+#       python -m benchmarks.bench_replica --workers 32 --seconds 20 --read-ratio 0.9
+#
+# Реплика — потоковый standby основного сервера (pg_basebackup -R). Кэш пользователей
+# выключен, чтобы чтения доходили до БД. Чтение — /balance и первая страница /history,
+# запись — резерв кредита и его возврат. Пользователи бенчмарка удаляются после прогона.
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from database import Database
+from migrations import migrate
+
+BENCH_TELEGRAM_BASE = 9_200_000_000
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "mean_ms": round(statistics.fmean(samples) * 1000, 3)}
+
+
+async def seed(db, users, generations):
+    async with db.acquire() as conn:
+        await conn.execute('DELETE FROM users WHERE telegram_id >= $1', BENCH_TELEGRAM_BASE)
+        await conn.execute('''
+            INSERT INTO users (telegram_id, balance)
+            SELECT $1::bigint + g, 1000000 FROM generate_series(0, $2 - 1) g
+        ''', BENCH_TELEGRAM_BASE, users)
+        await conn.execute('''
+            INSERT INTO generations (user_id, telegram_id, prompt, telegram_file_id, created_at)
+            SELECT u.id, u.telegram_id, 'bench ' || g, 'file_' || g, NOW() - make_interval(mins => g)
+            FROM users u, generate_series(1, $2) g
+            WHERE u.telegram_id >= $1
+        ''', BENCH_TELEGRAM_BASE, generations)
+        await conn.execute('ANALYZE users')
+        await conn.execute('ANALYZE generations')
+
+
+async def wait_replica(db, users, timeout=60):
+    """Пока реплика не догонит засев"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        async with db.replica_pool.acquire() as conn:
+            count = await conn.fetchval(
+                'SELECT count(*) FROM users WHERE telegram_id >= $1', BENCH_TELEGRAM_BASE
+            )
+        if count == users:
+            return
+        await asyncio.sleep(0.1)
+    sys.exit("реплика не догнала основной сервер")
+
+
+async def cleanup(db):
+    async with db.acquire() as conn:
+        await conn.execute('DELETE FROM users WHERE telegram_id >= $1', BENCH_TELEGRAM_BASE)
+
+
+async def run_once(db, users, workers, seconds, read_ratio):
+    reads, writes = [], []
+    stop = time.perf_counter() + seconds
+
+    async def worker():
+        while time.perf_counter() < stop:
+            telegram_id = BENCH_TELEGRAM_BASE + random.randrange(users)
+            started = time.perf_counter()
+            if random.random() < read_ratio:
+                await db.get_stats(telegram_id)
+                await db.get_user_generations(telegram_id)
+                reads.append(time.perf_counter() - started)
+            else:
+                reservation = await db.reserve_credits(telegram_id, 1)
+                await db.release_reservation(reservation['reservation_id'])
+                writes.append(time.perf_counter() - started)
+
+    routed_before = db.router.stats()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    elapsed = time.perf_counter() - started
+    routed = db.router.stats()
+
+    return {
+        "pools": "primary+replica" if db.replica_pool else "primary",
+        "workers": workers,
+        "seconds": round(elapsed, 2),
+        "ops_per_sec": round((len(reads) + len(writes)) / elapsed, 1),
+        "reads_per_sec": round(len(reads) / elapsed, 1),
+        "writes_per_sec": round(len(writes) / elapsed, 1),
+        "read": percentiles(reads),
+        "write": percentiles(writes),
+        "replica_reads": routed["replica_reads"] - routed_before["replica_reads"],
+        "primary_reads": routed["primary_reads"] - routed_before["primary_reads"],
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк маршрутизации чтений на реплику")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--generations", type=int, default=20, help="записей истории на пользователя")
+    parser.add_argument("--workers", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--seconds", type=float, default=15)
+    parser.add_argument("--read-ratio", type=float, default=0.9)
+    parser.add_argument("--pool-size", type=int, default=5, help="соединений в каждом пуле")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    dsn = os.getenv("BENCH_DATABASE_URL")
+    replica_dsn = os.getenv("BENCH_REPLICA_URL")
+    if not dsn or not replica_dsn:
+        sys.exit("BENCH_DATABASE_URL и BENCH_REPLICA_URL должны быть заданы")
+    random.seed(args.seed)
+
+    os.environ["DATABASE_URL"] = dsn
+    os.environ.pop("DATABASE_REPLICA_URL", None)
+    single = Database(user_cache_size=0, pool_min_size=args.pool_size, pool_max_size=args.pool_size)
+    await single.connect()
+    await migrate(single)
+
+    os.environ["DATABASE_REPLICA_URL"] = replica_dsn
+    split = Database(user_cache_size=0, pool_min_size=args.pool_size, pool_max_size=args.pool_size)
+    await split.connect()
+    if not split.replica_pool:
+        sys.exit("реплика недоступна")
+
+    results = []
+    try:
+        await seed(single, args.users, args.generations)
+        await wait_replica(split, args.users)
+        for workers in args.workers:
+            for db in (single, split):
+                results.append(await run_once(db, args.users, workers, args.seconds, args.read_ratio))
+                print(json.dumps(results[-1]), file=sys.stderr)
+    finally:
+        await cleanup(single)
+        await single.close()
+        await split.close()
+
+    report = json.dumps({
+        "benchmark": "replica",
+        "users": args.users,
+        "read_ratio": args.read_ratio,
+        "pool_size": args.pool_size,
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+# benchmarks/fake_telegram.py — сессия Bot без сети: записывает вызовы API и возвращает правдоподобные ответы
+import asyncio
+import itertools
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import Chat, Document, Message, PhotoSize, Update, User
+
+# Методы, которые в ответ возвращают сообщение
+MESSAGE_METHODS = {
+    "SendMessage", "SendPhoto", "SendDocument", "EditMessageText",
+    "EditMessageMedia", "EditMessageCaption", "EditMessageReplyMarkup", "CopyMessage",
+}
+
+
+class FakeSession(BaseSession):
+    """latency — задержка одного вызова API в секундах.
+
+    flood_every — каждый N-й вызов отвечает TelegramRetryAfter(retry_after),
+    чтобы проверить обработку flood-wait. blocked — chat_id, заблокировавшие
+    бота: им отвечает TelegramForbiddenError.
+    """
+
+    def __init__(self, latency=0.0, flood_every=0, retry_after=1, photo_size=150_000, blocked=()):
+        super().__init__()
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.photo_size = photo_size
+        self.blocked = set(blocked)
+        self.calls = Counter()
+        self.sent = defaultdict(list)  # chat_id -> [(метод, время)]
+        self._ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        total = sum(self.calls.values()) + 1
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_every and total % self.flood_every == 0:
+            raise TelegramRetryAfter(method=method, message="Flood control exceeded", retry_after=self.retry_after)
+
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id in self.blocked:
+            raise TelegramForbiddenError(method=method, message="Forbidden: bot was blocked by the user")
+        if chat_id is not None:
+            self.sent[chat_id].append((name, time.perf_counter()))
+
+        if name in MESSAGE_METHODS:
+            return self._message(chat_id or 0, photo=name in ("SendPhoto", "EditMessageMedia"),
+                                 document=name == "SendDocument")
+        if name == "SendMediaGroup":
+            return [self._message(chat_id, photo=True) for _ in method.media]
+        return True
+
+    def _message(self, chat_id, photo=False, document=False):
+        message_id = next(self._ids)
+        extra = {}
+        if photo:
+            extra["photo"] = [PhotoSize(
+                file_id=f"fake-photo-{message_id}",
+                file_unique_id=f"fake-{message_id}",
+                width=1024,
+                height=1024,
+                file_size=self.photo_size
+            )]
+        if document:
+            extra["document"] = Document(file_id=f"fake-doc-{message_id}", file_unique_id=f"fake-doc-{message_id}")
+        return Message(
+            message_id=message_id,
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            **extra
+        )
+
+
+_update_ids = itertools.count(1)
+
+
+def text_update(user_id, text):
+    """Апдейт с текстовым сообщением от пользователя user_id"""
+    update_id = next(_update_ids)
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=User(id=user_id, is_bot=False, first_name="Bench"),
+            text=text
+        )
+    )
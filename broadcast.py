@@ -0,0 +1,282 @@
+# broadcast.py — рассылка всем пользователям в пределах лимитов Telegram, с продолжением после перезапуска
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from contextlib import aclosing
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError
+)
+
+from metrics import BROADCAST_MESSAGES
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class _Run:
+    """Рассылка, выполняемая этим процессом"""
+
+    def __init__(self, row, queue_size):
+        self.id = row['id']
+        self.text = row['text']
+        self.chat_id = row['chat_id']
+        self.total = row['total']
+        self.checkpoint = row['last_user_id']
+        # Итоги до контрольной точки — то, что сохраняется в broadcasts
+        self.committed = Counter(delivered=row['delivered'], failed=row['failed'], blocked=row['blocked'])
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.pending = deque()  # users.id, отданные воркерам, по возрастанию
+        self.done = {}          # users.id -> результат, ещё за контрольной точкой
+        self.blocked_ids = []   # заблокировавшие бота с прошлой записи в БД
+        self.state = 'running'
+        self.started = time.monotonic()
+        self.processed = 0      # за этот запуск, для скорости
+
+    def complete(self, user_id, result):
+        self.done[user_id] = result
+        self.processed += 1
+        # Точка — наибольший id, до которого обработано всё. После перезапуска
+        # повторно получат сообщение только те, кто был за ней
+        while self.pending and self.pending[0] in self.done:
+            user_id = self.pending.popleft()
+            result = self.done.pop(user_id)
+            self.committed[result] += 1
+            if result == 'blocked':
+                self.blocked_ids.append(user_id)
+            self.checkpoint = user_id
+
+    def progress(self):
+        counts = self.committed + Counter(self.done.values())
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        left = max(self.total - sum(counts.values()), 0)
+        return {
+            "id": self.id,
+            "chat_id": self.chat_id,
+            "state": self.state,
+            "total": self.total,
+            "delivered": counts['delivered'],
+            "blocked": counts['blocked'],
+            "failed": counts['failed'],
+            "rate": rate,
+            "eta": left / rate if rate else None,
+        }
+
+
+class Broadcaster:
+    """Рассылка текста всем пользователям; одновременно — одна на все реплики.
+
+    Получатели читаются серверным курсором пачками по segment (по
+    возрастанию users.id) в ограниченную очередь. workers воркеров
+    отправляют сообщения, забирая токены общего TokenBucket: rate сообщений
+    в секунду, ниже лимита Telegram (~30/с). TelegramRetryAfter
+    приостанавливает всех воркеров на retry_after, сообщение повторяется.
+
+    Каждые checkpoint_interval секунд прогресс пишется в broadcasts и
+    продлевается аренда (lease). Рассылку остановленного процесса любая
+    реплика продолжает сразу, упавшего — по истечении аренды, с последней
+    контрольной точки: сообщения, бывшие в работе, могут прийти повторно.
+    on_progress(progress) вызывается раз в report_interval секунд и в конце.
+    """
+
+    def __init__(self, db, bot, rate=25, workers=8, segment=1000, lease=30, checkpoint_interval=2.0,
+                 report_interval=10.0, poll_interval=5.0, max_attempts=5, on_progress=None):
+        self.db = db
+        self.bot = bot
+        self.workers = workers
+        self.segment = segment
+        self.lease = lease
+        self.checkpoint_interval = checkpoint_interval
+        self.report_interval = report_interval
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.on_progress = on_progress
+        self.bucket = TokenBucket(rate, 1)  # без запаса: сообщения идут равномерно
+        self.current = None
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._poller = None
+
+        self.retry_afters = 0
+
+    def start(self):
+        self._poller = asyncio.create_task(self._poll(), name="broadcast-poller")
+
+    async def stop(self):
+        """Остановка: текущая рассылка сохраняет точку и отпускает аренду"""
+        if self._poller:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+    def wake(self):
+        """Новая рассылка запущена — проверить, не взять ли её, не дожидаясь опроса"""
+        self._wakeup.set()
+
+    async def _poll(self):
+        while True:
+            row = None
+            try:
+                row = await self.db.claim_broadcast(self.db.instance_id, self.lease)
+            except Exception as e:
+                logger.error(f"❌ Ошибка получения рассылки: {e}")
+            if row:
+                try:
+                    await self._run(row)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ Рассылка {row['id']} прервана: {e}", exc_info=True)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _run(self, row):
+        run = self.current = _Run(row, queue_size=self.workers * 4)
+        logger.info(f"📣 Рассылка {run.id}: старт после users.id {run.checkpoint}")
+        producer = asyncio.create_task(self._produce(run), name=f"broadcast-{run.id}-producer")
+        workers = [
+            asyncio.create_task(self._worker(run), name=f"broadcast-{run.id}-worker-{n}")
+            for n in range(self.workers)
+        ]
+        last_ok = reported = time.monotonic()
+        finished = False
+        try:
+            while True:
+                await asyncio.wait(workers, timeout=self.checkpoint_interval)
+                if all(worker.done() for worker in workers):
+                    # Завершена, только если курсор дочитан и каждый получатель обработан
+                    finished = (
+                        producer.done() and not producer.cancelled() and producer.exception() is None
+                        and not run.pending
+                    )
+                    break
+                if producer.done() and not producer.cancelled() and producer.exception():
+                    raise producer.exception()
+
+                state = await self._checkpoint(run, self.lease)
+                if state is not None:
+                    last_ok = time.monotonic()
+                elif time.monotonic() - last_ok > self.lease:
+                    # БД недоступна дольше аренды — рассылку мог забрать другой процесс
+                    state = 'lost'
+                if state and state != 'running':
+                    run.state = state
+                    break
+                if self.on_progress and time.monotonic() - reported >= self.report_interval:
+                    reported = time.monotonic()
+                    await self._report(run)
+        finally:
+            for task in (producer, *workers):
+                task.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+            # Остановленная администратором тоже сохраняет итоги и отпускает аренду
+            if run.state in ('running', 'canceled'):
+                state = await self._checkpoint(run, None, finished=finished)
+                run.state = state or 'lost'
+            self.current = None
+
+        progress = run.progress()
+        logger.info(
+            f"📣 Рассылка {run.id}: {run.state}, доставлено {progress['delivered']}, "
+            f"заблокировали {progress['blocked']}, ошибок {progress['failed']}, {progress['rate']:.1f}/с"
+        )
+        await self._report(run)
+
+    async def _checkpoint(self, run, lease, finished=False):
+        """Запись прогресса; lease=None — отпустить аренду. Возвращает state или None при ошибке"""
+        blocked_ids, run.blocked_ids = run.blocked_ids, []
+        try:
+            state = await self.db.checkpoint_broadcast(
+                run.id, self.db.instance_id, run.checkpoint,
+                run.committed['delivered'], run.committed['failed'], run.committed['blocked'],
+                blocked_ids, lease, finished
+            )
+        except Exception as e:
+            run.blocked_ids[:0] = blocked_ids
+            logger.warning(f"⚠️ Рассылка {run.id}: не удалось сохранить прогресс: {e}")
+            return None
+        # Строку забрал другой процесс (наша аренда истекла)
+        return state if state is not None else 'lost'
+
+    async def _report(self, run):
+        if not self.on_progress:
+            return
+        try:
+            await self.on_progress(run.progress())
+        except Exception as e:
+            logger.warning(f"⚠️ Рассылка {run.id}: отчёт не отправлен: {e}")
+
+    async def _produce(self, run):
+        after = run.checkpoint
+        while True:
+            count = 0
+            async with aclosing(self.db.broadcast_recipients(after, self.segment)) as recipients:
+                async for row in recipients:
+                    run.pending.append(row['id'])
+                    await run.queue.put((row['id'], row['telegram_id']))
+                    after = row['id']
+                    count += 1
+            if count < self.segment:
+                break
+        for _ in range(self.workers):
+            await run.queue.put(None)
+
+    async def _worker(self, run):
+        while True:
+            item = await run.queue.get()
+            if item is None:
+                return
+            user_id, telegram_id = item
+            try:
+                result = await self._deliver(run, telegram_id)
+            except Exception as e:
+                # Неожиданная ошибка не должна останавливать воркер и контрольную точку
+                logger.error(f"❌ Рассылка {run.id}: {telegram_id} не получил сообщение: {e}", exc_info=True)
+                result = 'failed'
+            BROADCAST_MESSAGES.inc(result)
+            run.complete(user_id, result)
+
+    async def _deliver(self, run, telegram_id):
+        """delivered, blocked (бот заблокирован или аккаунт удалён) или failed"""
+        attempts = 0
+        while True:
+            await self._pace()
+            try:
+                await self.bot.send_message(telegram_id, run.text)
+                return 'delivered'
+            except TelegramRetryAfter as e:
+                # Telegram просит замолчать весь бот, а не одного воркера
+                self.retry_afters += 1
+                BROADCAST_MESSAGES.inc('retry_after')
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning(f"⚠️ Рассылка {run.id}: flood control, пауза {e.retry_after} с")
+            except TelegramForbiddenError:
+                return 'blocked'
+            except TelegramBadRequest as e:
+                logger.debug(f"Рассылка {run.id}: {telegram_id} не получил сообщение: {e}")
+                return 'failed'
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    logger.warning(f"⚠️ Рассылка {run.id}: {telegram_id} не получил сообщение: {e}")
+                    return 'failed'
+                await asyncio.sleep(min(2 ** attempts, 30))
+
+    async def _pace(self):
+        """Ждать окончания паузы flood control и своего токена"""
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+            # Пока ждали токен, могла начаться новая пауза — тогда токен берём заново после неё
+            if self._paused_until <= time.monotonic():
+                return
@@ -0,0 +1,115 @@
+# cache.py — кэш результатов генерации: повторный промпт = повторная отправка file_id
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Регистр и пробелы не влияют на результат генерации"""
+    return " ".join(prompt.lower().split())
+
+
+def make_cache_key(prompt, model, aspect_ratio, output_format) -> str:
+    raw = "\x1f".join((normalize_prompt(prompt), model, aspect_ratio, output_format))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+@dataclass
+class CachedResult:
+    file_id: str
+    image_url: str = None
+    file_size: int = 0        # байт, не загруженных повторно
+    gen_seconds: float = 0.0  # секунд генерации, сэкономленных на попадании
+    stored_at: float = 0.0
+
+
+class ResultCache:
+    """In-memory LRU с TTL поверх индексированного поиска в таблице generations"""
+
+    def __init__(self, db, max_size=5000, ttl=86400):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+        # Средние по промахам — оценка экономии для записей, поднятых из БД
+        self._avg_bytes = 0.0
+        self._avg_seconds = 0.0
+
+    async def get(self, key):
+        result = self._get_memory(key)
+        if result:
+            self.memory_hits += 1
+        else:
+            row = await self.db.find_cached_generation(key, self.ttl)
+            if not row:
+                self.misses += 1
+                return None
+            result = CachedResult(
+                file_id=row['telegram_file_id'],
+                image_url=row['image_url'],
+                file_size=int(self._avg_bytes),
+                gen_seconds=self._avg_seconds,
+                stored_at=time.monotonic() - float(row['age'])
+            )
+            self._store(key, result)
+            self.db_hits += 1
+
+        self.bytes_saved += result.file_size
+        self.seconds_saved += result.gen_seconds
+        return result
+
+    def put(self, key, file_id, image_url=None, file_size=0, gen_seconds=0.0):
+        self._avg_bytes += ((file_size or 0) - self._avg_bytes) * 0.1
+        self._avg_seconds += (gen_seconds - self._avg_seconds) * 0.1
+        self._store(key, CachedResult(
+            file_id=file_id,
+            image_url=image_url,
+            file_size=file_size or 0,
+            gen_seconds=gen_seconds,
+            stored_at=time.monotonic()
+        ))
+
+    def stats(self):
+        hits = self.memory_hits + self.db_hits
+        total = hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "bytes_saved": self.bytes_saved,
+            "seconds_saved": round(self.seconds_saved, 1),
+        }
+
+    def _get_memory(self, key):
+        result = self._items.get(key)
+        if result is None:
+            return None
+        if time.monotonic() - result.stored_at > self.ttl:
+            del self._items[key]
+            self.expired += 1
+            return None
+        self._items.move_to_end(key)
+        return result
+
+    def _store(self, key, result):
+        self._items[key] = result
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
@@ -9,9 +9,142 @@ REPLICATE_API_KEY = os.getenv("REPLICATE_API_KEY")
 
 # Настройки моделей
 REPLICATE_MODEL = "black-forest-labs/flux-1-dev"
+REPLICATE_FAST_MODEL = "black-forest-labs/flux-schnell"
 DEFAULT_ASPECT_RATIO = "1:1"
 DEFAULT_OUTPUT_FORMAT = "webp"
 
 # Бизнес-логика
 COST_STANDARD = 1
 FREE_GENERATIONS = 3
+
+# Уровни моделей: быстрый (REPLICATE_FAST_MODEL) и качественный (REPLICATE_MODEL).
+# Цена в кредитах, ожидаемая длительность (с) и лимит одновременных генераций на процесс.
+# Если ожидание на выбранном уровне (p95 или прогноз по очереди) больше TIER_MAX_WAIT
+# секунд, генерация уходит на быстрый
+TIER_FAST_COST = int(os.getenv("TIER_FAST_COST", "1"))
+TIER_FAST_LATENCY = float(os.getenv("TIER_FAST_LATENCY", "2"))
+TIER_FAST_CONCURRENCY = int(os.getenv("TIER_FAST_CONCURRENCY", "16"))
+TIER_QUALITY_COST = int(os.getenv("TIER_QUALITY_COST", str(COST_STANDARD)))
+TIER_QUALITY_LATENCY = float(os.getenv("TIER_QUALITY_LATENCY", "10"))
+TIER_QUALITY_CONCURRENCY = int(os.getenv("TIER_QUALITY_CONCURRENCY", "8"))
+DEFAULT_TIER = os.getenv("DEFAULT_TIER", "quality")  # fast или quality
+TIER_MAX_WAIT = float(os.getenv("TIER_MAX_WAIT", "30"))  # секунд
+TIER_WAIT_HORIZON = float(os.getenv("TIER_WAIT_HORIZON", "120"))  # p95 ожидания за это окно, с
+
+# Планировщик генераций
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "8"))
+GENERATION_QUEUE_SIZE = int(os.getenv("GENERATION_QUEUE_SIZE", "200"))
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "2"))
+
+# Кэш результатов генерации
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "5000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "86400"))  # секунд
+CACHE_CHARGE_HITS = os.getenv("CACHE_CHARGE_HITS", "true").lower() in ("1", "true", "yes")
+
+# Администраторы (через запятую)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Резервирование кредитов: незакрытый резерв возвращается на баланс
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", "900"))  # секунд
+RESERVATION_SWEEP_INTERVAL = int(os.getenv("RESERVATION_SWEEP_INTERVAL", "60"))
+
+# Отложенная запись истории генераций
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0"))  # секунд
+HISTORY_MAX_BUFFER = int(os.getenv("HISTORY_MAX_BUFFER", "10000"))
+
+# Кэш пользователей в памяти процесса
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# Пул соединений с БД на процесс: DB_POOL_MIN_SIZE соединений открываются и прогреваются
+# при запуске. DB_POOL_MAX_SIZE не меньше 2 — миграции держат одно под блокировкой
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+
+# Реплика для чтений (DATABASE_REPLICA_URL, необязательно; пул того же размера).
+# Чтения уходят на основной сервер, если реплика отстала больше REPLICA_MAX_LAG секунд,
+# и для пользователя, чьи данные менялись последние REPLICA_READ_YOUR_WRITES секунд
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_READ_YOUR_WRITES = float(os.getenv("REPLICA_READ_YOUR_WRITES", "5"))
+
+# Режим приёма апдейтов: polling (одна реплика) или webhook (несколько процессов/реплик)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))  # процессов на одном порту
+# setWebhook вызывает только одна реплика; на остальных узлах — false
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "true").lower() in ("1", "true", "yes")
+PROCESSED_UPDATES_TTL = int(os.getenv("PROCESSED_UPDATES_TTL", "86400"))  # секунд
+
+# Очередь генераций в Postgres: задача переживает перезапуск, её забирает любая реплика.
+# false — очередь в памяти процесса (GenerationScheduler)
+DURABLE_JOBS = os.getenv("DURABLE_JOBS", "true").lower() in ("1", "true", "yes")
+JOB_LEASE = int(os.getenv("JOB_LEASE", "120"))  # секунд, продлевается пока задача идёт
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", "5"))  # секунд, удваивается на каждой попытке
+JOB_RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", "300"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", "604800"))  # завершённые задачи храним неделю
+
+# Клиент Replicate (REPLICATE_API_URL=http://localhost:9000/v1 — локальный fake_replicate.py)
+REPLICATE_API_URL = os.getenv("REPLICATE_API_URL", "https://api.replicate.com/v1")
+REPLICATE_TIMEOUT = float(os.getenv("REPLICATE_TIMEOUT", "180"))  # секунд на генерацию
+REPLICATE_POLL_MIN = float(os.getenv("REPLICATE_POLL_MIN", "0.5"))
+REPLICATE_POLL_MAX = float(os.getenv("REPLICATE_POLL_MAX", "3.0"))
+REPLICATE_POOL_SIZE = int(os.getenv("REPLICATE_POOL_SIZE", "100"))  # keep-alive соединений
+REPLICATE_WEBHOOK_PATH = os.getenv("REPLICATE_WEBHOOK_PATH", "/replicate")
+
+# Метрики Prometheus: отдельный сервер /metrics на METRICS_HOST:METRICS_PORT (0 — выключен),
+# не на публичном порту вебхука. Процесс вебхука #N слушает METRICS_PORT + N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Апдейты и генерации дольше порога пишутся в лог с разбивкой по спанам (0 — выключено)
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "0"))
+
+# Ограничение частоты апдейтов (на процесс): пользователь — RATE_LIMIT_USER_RATE в секунду
+# с запасом RATE_LIMIT_USER_BURST; весь процесс — RATE_LIMIT_GLOBAL_RATE, лишнее ждёт
+# в очереди до RATE_LIMIT_MAX_WAIT секунд, затем отказ
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "1"))
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", "5"))
+RATE_LIMIT_GLOBAL_RATE = float(os.getenv("RATE_LIMIT_GLOBAL_RATE", "50"))
+RATE_LIMIT_GLOBAL_BURST = int(os.getenv("RATE_LIMIT_GLOBAL_BURST", "100"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "2"))
+
+# Адаптивный лимит одновременных генераций: ×0.5 при 429, +1 за окно успешных вызовов
+BACKEND_CONCURRENCY_INITIAL = int(os.getenv("BACKEND_CONCURRENCY_INITIAL", "8"))
+BACKEND_CONCURRENCY_MIN = int(os.getenv("BACKEND_CONCURRENCY_MIN", "1"))
+BACKEND_CONCURRENCY_MAX = int(os.getenv("BACKEND_CONCURRENCY_MAX", "64"))
+
+# Постобработка: результат скачивается один раз, в Telegram уходит JPEG-превью
+# и (IMAGE_SEND_ORIGINAL) оригинал документом. IMAGE_WORKERS=0 — по числу ядер,
+# поделённому на WEBHOOK_WORKERS
+IMAGE_POSTPROCESS = os.getenv("IMAGE_POSTPROCESS", "true").lower() in ("1", "true", "yes")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0"))
+IMAGE_PREVIEW_SIZE = int(os.getenv("IMAGE_PREVIEW_SIZE", "1280"))  # px по длинной стороне
+IMAGE_PREVIEW_QUALITY = int(os.getenv("IMAGE_PREVIEW_QUALITY", "85"))
+IMAGE_SEND_ORIGINAL = os.getenv("IMAGE_SEND_ORIGINAL", "true").lower() in ("1", "true", "yes")
+
+# Пакетная генерация (/batch): сколько вариантов можно выбрать; одно предсказание
+# с num_outputs=N, одна медиагруппа (не больше 4 у FLUX)
+BATCH_SIZES = [int(size) for size in os.getenv("BATCH_SIZES", "2,4").split(",")]
+
+# Секции generations по месяцам: создаются на GENERATIONS_PARTITIONS_AHEAD месяцев вперёд;
+# секции старше GENERATIONS_RETENTION_MONTHS выгружаются в GENERATIONS_ARCHIVE_DIR
+# (*.csv.gz) и удаляются. 0 — хранить всё
+GENERATIONS_PARTITIONS_AHEAD = int(os.getenv("GENERATIONS_PARTITIONS_AHEAD", "2"))
+GENERATIONS_RETENTION_MONTHS = int(os.getenv("GENERATIONS_RETENTION_MONTHS", "12"))
+GENERATIONS_ARCHIVE_DIR = os.getenv("GENERATIONS_ARCHIVE_DIR", "archive")
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))  # секунд
+
+# Рассылки (/broadcast): BROADCAST_RATE сообщений в секунду на весь бот (лимит Telegram ~30/с),
+# BROADCAST_WORKERS одновременных отправок, получатели читаются курсором по BROADCAST_SEGMENT.
+# Прогресс сохраняется каждые BROADCAST_CHECKPOINT_INTERVAL секунд; рассылку упавшего
+# процесса другая реплика продолжает через BROADCAST_LEASE секунд
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_SEGMENT = int(os.getenv("BROADCAST_SEGMENT", "1000"))
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "2"))
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "30"))  # секунд
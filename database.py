@@ -1,11 +1,110 @@
 # database.py — ИСПРАВЛЕННАЯ ВЕРСИЯ ДЛЯ RAILWAY
+import asyncio
 import asyncpg
+import functools
+import logging
 import os
+import re
+import secrets
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
 from urllib.parse import urlparse
 
+from metrics import DB_POOL_WAIT_SECONDS, DB_QUERY_SECONDS, DB_READS, DB_REPLICA_LAG, span
+from partitions import month_start, partition_name
+from replica import REPLICA_LAG_SQL, ReadRouter
+from usercache import UserCache
+
+logger = logging.getLogger(__name__)
+
+USER_CHANGED_CHANNEL = 'user_changed'
+
+# Ключи pg_advisory_lock: обслуживание выполняет одна реплика
+PARTITIONS_LOCK = 160001
+SCHEMA_LOCK = 160003
+BROADCAST_LOCK = 160004
+
+# Частые запросы. Текст запроса — ключ кэша подготовленных выражений asyncpg,
+# поэтому прогрев соединения (_prewarm) использует те же строки
+USER_SQL = 'SELECT id, balance, total_generations, preferred_tier FROM users WHERE telegram_id = $1'
+HISTORY_FIRST_PAGE_SQL = '''
+    SELECT id, prompt, telegram_file_id, cost, created_at FROM generations
+    WHERE telegram_id = $1 AND telegram_file_id IS NOT NULL
+    ORDER BY created_at DESC, id DESC
+    LIMIT $2
+'''
+HISTORY_OLDER_SQL = '''
+    SELECT id, prompt, telegram_file_id, cost, created_at FROM generations
+    WHERE telegram_id = $1 AND telegram_file_id IS NOT NULL
+      AND (created_at, id) < ($2, $3) AND created_at <= $2
+    ORDER BY created_at DESC, id DESC
+    LIMIT $4
+'''
+HISTORY_NEWER_SQL = '''
+    SELECT id, prompt, telegram_file_id, cost, created_at FROM generations
+    WHERE telegram_id = $1 AND telegram_file_id IS NOT NULL
+      AND (created_at, id) > ($2, $3) AND created_at >= $2
+    ORDER BY created_at, id
+    LIMIT $4
+'''
+CACHED_GENERATION_SQL = '''
+    SELECT telegram_file_id, image_url,
+           EXTRACT(EPOCH FROM NOW() - created_at) AS age
+    FROM generations
+    WHERE cache_key = $1
+      AND telegram_file_id IS NOT NULL
+      AND created_at > NOW() - make_interval(secs => $2)
+    ORDER BY created_at DESC
+    LIMIT 1
+'''
+# Реплика недоступна или отменила запрос (конфликт с применением WAL) — читаем с основного
+REPLICA_ERRORS = (
+    OSError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError,
+    asyncpg.OperatorInterventionError, asyncpg.SerializationError
+)
+
+# Только чтение; аргументы, которые ничего не находят
+PREWARM_QUERIES = [
+    (USER_SQL, (0,)),
+    (HISTORY_FIRST_PAGE_SQL, (0, 1)),
+    (HISTORY_OLDER_SQL, (0, datetime(2000, 1, 1), 0, 1)),
+    (HISTORY_NEWER_SQL, (0, datetime(2000, 1, 1), 0, 1)),
+    (CACHED_GENERATION_SQL, ('', 1.0)),
+]
+
+def timed(method):
+    """Время метода Database в метрике bot_db_query_seconds и спан трассы"""
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with span(f"db.{name}"):
+                return await method(self, *args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
 class Database:
-    def __init__(self):
+    def __init__(self, user_cache_size=10000, pool_min_size=1, pool_max_size=5,
+                 replica_max_lag=5.0, read_your_writes=5.0):
         self.pool = None
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        # Необязательная реплика для чтений (DATABASE_REPLICA_URL), см. _read
+        self.replica_pool = None
+        self.router = ReadRouter(max_lag=replica_max_lag, read_your_writes=read_your_writes)
+        self._replica_task = None
+        self.users = UserCache(user_cache_size)
+        # Имя процесса в application_name: по нему отличаем свои NOTIFY от чужих
+        self.instance_id = f"ai_image_bot-{os.getpid()}-{secrets.token_hex(4)}"
+        self._dsn = None
+        self._ssl_kwargs = {}
+        self._listener = None
+        self._listener_task = None
     
     async def connect(self):
         """Подключение к базе данных с правильной обработкой хостов Railway"""
@@ -28,24 +127,36 @@ class Database:
             # 🔧 Для публичных хостов используем стандартные настройки
             if is_internal:
                 # Внутреннее подключение без SSL
+                self._ssl_kwargs = {'ssl': None}  # ЯВНО отключаем SSL для внутренних хостов
                 self.pool = await asyncpg.create_pool(
                     db_url,
-                    min_size=1,
-                    max_size=5,
+                    min_size=self.pool_min_size,
+                    max_size=self.pool_max_size,
+                    init=self._prewarm,
+                    max_cached_statement_lifetime=0,
                     command_timeout=60,
-                    ssl=None  # ЯВНО отключаем SSL для внутренних хостов
+                    server_settings={'application_name': self.instance_id},
+                    **self._ssl_kwargs
                 )
             else:
                 # Публичное подключение с автоматическим SSL
                 self.pool = await asyncpg.create_pool(
                     db_url,
-                    min_size=1,
-                    max_size=5,
-                    command_timeout=60
+                    min_size=self.pool_min_size,
+                    max_size=self.pool_max_size,
+                    init=self._prewarm,
+                    max_cached_statement_lifetime=0,
+                    command_timeout=60,
+                    server_settings={'application_name': self.instance_id}
                 )
             
+            self._dsn = db_url
             print(f"✅ Подключение к БД установлено")
             
+            replica_url = os.getenv("DATABASE_REPLICA_URL")
+            if replica_url:
+                await self._connect_replica(replica_url)
+            
         except Exception as e:
             error_msg = str(e).lower()
             
@@ -64,149 +175,767 @@ class Database:
             else:
                 raise ConnectionError(f"❌ Ошибка подключения: {str(e)}")
     
+    async def _connect_replica(self, replica_url):
+        """Пул к реплике; если она недоступна, все чтения идут на основной сервер"""
+        host = urlparse(replica_url).hostname or ""
+        ssl_kwargs = {'ssl': None} if "railway.internal" in host else {}
+        try:
+            self.replica_pool = await asyncpg.create_pool(
+                replica_url,
+                min_size=self.pool_min_size,
+                max_size=self.pool_max_size,
+                init=self._prewarm,
+                max_cached_statement_lifetime=0,
+                command_timeout=60,
+                server_settings={'application_name': self.instance_id},
+                **ssl_kwargs
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Реплика БД недоступна, чтения идут на основной сервер: {e}")
+            return
+        self._replica_task = asyncio.ensure_future(self._watch_replica())
+        logger.info(f"✅ Подключение к реплике БД установлено: {host}")
+    
+    async def _watch_replica(self):
+        """Раз в check_interval секунд — отставание реплики; при ошибке чтения уходят на основной"""
+        while True:
+            try:
+                async with self.replica_pool.acquire() as conn:
+                    self.router.lag = await conn.fetchval(REPLICA_LAG_SQL)
+            except Exception as e:
+                if self.router.lag is not None:
+                    logger.warning(f"⚠️ Реплика БД не отвечает: {e}")
+                self.router.lag = None
+            DB_REPLICA_LAG.set(-1 if self.router.lag is None else self.router.lag)
+            await asyncio.sleep(self.router.check_interval)
+    
+    async def _prewarm(self, conn):
+        """init пула: частые запросы подготовлены и каталог таблиц прочитан до первого апдейта"""
+        for query, args in PREWARM_QUERIES:
+            try:
+                await conn.fetch(query, *args)
+            except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+                return  # пустая или старая БД: таблицы и колонки появятся после миграций
+    
+    @asynccontextmanager
+    async def acquire(self):
+        """Соединение из пула; ожидание свободного соединения попадает в метрики"""
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+            yield conn
+    
+    async def _read(self, method, query, *args, telegram_id=None):
+        """Запрос только на чтение (conn.<method>): на реплику, если позволяют правила ReadRouter.
+
+        telegram_id — чьи данные читаем (read-your-writes). Пока LISTEN не работает,
+        о чужих изменениях пользователя не узнать — такие чтения идут на основной.
+        Если реплика упала или отменила запрос из-за конфликта с восстановлением,
+        запрос повторяется на основном сервере.
+        """
+        if (
+            self.replica_pool is not None
+            and (telegram_id is None or self.users.enabled)
+            and self.router.use_replica(telegram_id)
+        ):
+            started = time.perf_counter()
+            try:
+                async with self.replica_pool.acquire() as conn:
+                    DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+                    result = await getattr(conn, method)(query, *args)
+                DB_READS.inc("replica")
+                return result
+            except REPLICA_ERRORS as e:
+                logger.warning(f"⚠️ Чтение с реплики не удалось, повтор на основном: {e}")
+                if not isinstance(e, asyncpg.SerializationError):
+                    self.router.lag = None  # до следующей проверки _watch_replica
+        DB_READS.inc("primary")
+        async with self.acquire() as conn:
+            return await getattr(conn, method)(query, *args)
+    
     async def close(self):
         """Безопасное закрытие соединения"""
+        await self.stop_listener()
+        if self._replica_task:
+            self._replica_task.cancel()
+            self._replica_task = None
+        if self.replica_pool:
+            await self.replica_pool.close()
+            self.replica_pool = None
         if self.pool:
             await self.pool.close()
             print("🔌 Соединение с БД закрыто")
     
-    async def create_tables(self):
-        """Создание таблиц если не существуют"""
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    last_name VARCHAR(255),
-                    balance INTEGER DEFAULT 0,
-                    total_generations INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    last_active TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-            
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS generations (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                    telegram_id BIGINT NOT NULL,
-                    prompt TEXT NOT NULL,
-                    negative_prompt TEXT,
-                    image_url TEXT,
-                    telegram_file_id VARCHAR(255),
-                    cost INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-            
+    # ===== ВЕРСИЯ СХЕМЫ (migrations.py) =====
+    @timed
+    async def schema_version(self):
+        """Номер последней применённой миграции; 0 — схема ещё не версионировалась"""
+        async with self.acquire() as conn:
+            try:
+                return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+            except asyncpg.UndefinedTableError:
+                return 0
+    
+    @timed
+    async def record_migration(self, version, description):
+        async with self.acquire() as conn:
             await conn.execute('''
-                CREATE TABLE IF NOT EXISTS purchases (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                    telegram_id BIGINT NOT NULL,
-                    package VARCHAR(50) NOT NULL,
-                    amount_rub INTEGER NOT NULL,
-                    credits_added INTEGER NOT NULL,
-                    payment_id VARCHAR(255) UNIQUE,
-                    status VARCHAR(20) DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    paid_at TIMESTAMP
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT NOW()
                 )
             ''')
-            
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)')
-            await conn.execute('CREATE INDEX IF NOT EXISTS idx_generations_telegram_id ON generations(telegram_id)')
-            
-            print("✅ Таблицы БД проверены/созданы")
+            await conn.execute(
+                'INSERT INTO schema_migrations (version, description) VALUES ($1, $2)',
+                version, description
+            )
+    
+    # ===== ИНВАЛИДАЦИЯ КЭША ПОЛЬЗОВАТЕЛЕЙ =====
+    async def start_listener(self):
+        """Отдельное соединение под LISTEN: изменения из других реплик сбрасывают кэш"""
+        self._listener = await asyncpg.connect(
+            self._dsn,
+            server_settings={'application_name': self.instance_id},
+            **self._ssl_kwargs
+        )
+        await self._listener.add_listener(USER_CHANGED_CHANNEL, self._on_user_changed)
+        self._listener.add_termination_listener(self._on_listener_lost)
+        self.users.enabled = True
+    
+    async def stop_listener(self):
+        if self._listener_task:
+            self._listener_task.cancel()
+            self._listener_task = None
+        if self._listener:
+            listener, self._listener = self._listener, None
+            await listener.close()
+    
+    def _on_user_changed(self, connection, pid, channel, payload):
+        origin, _, telegram_id = payload.rpartition(':')
+        if origin != self.instance_id:
+            self.users.invalidate(int(telegram_id))
+            self.router.wrote(int(telegram_id))
+    
+    def _on_listener_lost(self, connection):
+        # Пока LISTEN не работает, чужие изменения не видны — кэш выключаем
+        if self._listener is not connection:
+            return
+        logger.warning("⚠️ Соединение LISTEN потеряно, кэш пользователей отключён")
+        self._listener = None
+        self.users.enabled = False
+        self.users.clear()
+        self._listener_task = asyncio.ensure_future(self._reconnect_listener())
+    
+    async def _reconnect_listener(self):
+        delay = 1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.start_listener()
+                logger.info("✅ Соединение LISTEN восстановлено, кэш пользователей включён")
+                self._listener_task = None
+                return
+            except Exception as e:
+                logger.error(f"❌ Не удалось восстановить LISTEN: {e}")
+                delay = min(delay * 2, 60)
+    
+    async def _user_id(self, conn, telegram_id):
+        cached = self.users.get(telegram_id)
+        if cached:
+            return cached['id']
+        row = await conn.fetchrow(USER_SQL, telegram_id)
+        if not row:
+            return None
+        self.users.put(telegram_id, row)
+        return row['id']
     
     # ===== ОСНОВНЫЕ МЕТОДЫ =====
+    @timed
     async def create_user(self, telegram_id, username=None, first_name=None, last_name=None):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
+        async with self.acquire() as conn:
+            row = await conn.fetchrow('''
                 INSERT INTO users (telegram_id, username, first_name, last_name, balance)
                 VALUES ($1, $2, $3, $4, $5)
                 ON CONFLICT (telegram_id) DO UPDATE 
                 SET last_active = NOW(),
+                    blocked_at = NULL,
                     username = EXCLUDED.username,
                     first_name = EXCLUDED.first_name,
                     last_name = EXCLUDED.last_name
+                RETURNING id, balance, total_generations, preferred_tier
             ''', telegram_id, username, first_name, last_name, 0)
+            self.users.put(telegram_id, row)
+            self.router.wrote(telegram_id)
     
+    @timed
     async def add_credits(self, telegram_id, amount):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
+        async with self.acquire() as conn:
+            row = await conn.fetchrow('''
                 UPDATE users SET balance = balance + $1, last_active = NOW()
                 WHERE telegram_id = $2
+                RETURNING id, balance, total_generations, preferred_tier
             ''', amount, telegram_id)
+            if row:
+                self.users.put(telegram_id, row)
+                self.router.wrote(telegram_id)
     
-    async def deduct_credits(self, telegram_id, amount):
-        async with self.pool.acquire() as conn:
-            result = await conn.execute('''
-                UPDATE users SET balance = balance - $1, last_active = NOW()
-                WHERE telegram_id = $2 AND balance >= $1
-            ''', amount, telegram_id)
-            return "UPDATE 1" in result
+    @timed
+    async def get_user(self, telegram_id):
+        """Строка пользователя (id, balance, total_generations, preferred_tier) из кэша или из БД"""
+        cached = self.users.get(telegram_id)
+        if cached:
+            return cached
+        written_at = self.router.written_at(telegram_id)
+        row = await self._read('fetchrow', USER_SQL, telegram_id, telegram_id=telegram_id)
+        if not row:
+            return None
+        # Запись, пришедшая во время чтения, делает строку устаревшей — в кэш её не кладём
+        if self.router.written_at(telegram_id) != written_at:
+            return dict(row)
+        self.users.put(telegram_id, row)
+        return self.users.peek(telegram_id) or dict(row)
     
+    @timed
     async def get_balance(self, telegram_id):
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                'SELECT balance FROM users WHERE telegram_id = $1',
-                telegram_id
-            )
-            return row['balance'] if row else 0
+        user = await self.get_user(telegram_id)
+        return user['balance'] if user else 0
     
+    @timed
     async def get_stats(self, telegram_id):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow('''
-                SELECT 
-                    COALESCE(balance, 0) as balance,
-                    (SELECT COUNT(*) FROM generations WHERE telegram_id = $1) as generations_count
-                FROM users WHERE telegram_id = $1
-            ''', telegram_id)
-    
-    async def save_generation(self, telegram_id, prompt, image_url=None, file_id=None, 
-                             cost=1, negative_prompt=None):
-        async with self.pool.acquire() as conn:
-            user = await conn.fetchrow(
-                'SELECT id FROM users WHERE telegram_id = $1',
-                telegram_id
+        """Баланс и число генераций по счётчику users.total_generations — без COUNT(*) по истории"""
+        user = await self.get_user(telegram_id)
+        if not user:
+            return None
+        return {
+            'balance': user['balance'] or 0,
+            'generations_count': user['total_generations'] or 0
+        }
+    
+    @timed
+    async def set_preferred_tier(self, telegram_id, tier):
+        """Уровень модели по умолчанию для пользователя (None — общий по умолчанию)"""
+        async with self.acquire() as conn:
+            row = await conn.fetchrow('''
+                UPDATE users SET preferred_tier = $1
+                WHERE telegram_id = $2
+                RETURNING id, balance, total_generations, preferred_tier
+            ''', tier, telegram_id)
+            if not row:
+                return False
+            self.users.put(telegram_id, row)
+            self.router.wrote(telegram_id)
+            return True
+    
+    # ===== РЕЗЕРВИРОВАНИЕ КРЕДИТОВ =====
+    # Кредиты списываются до генерации одним запросом; по итогу резерв либо
+    # превращается в запись generations, либо возвращается на баланс.
+    @timed
+    async def reserve_credits(self, telegram_id, amount):
+        """Атомарное списание в резерв. Возвращает (reservation_id, balance) или None"""
+        async with self.acquire() as conn:
+            row = await conn.fetchrow('''
+                WITH charged AS (
+                    UPDATE users SET balance = balance - $2, last_active = NOW()
+                    WHERE telegram_id = $1 AND balance >= $2
+                    RETURNING id, balance, total_generations, preferred_tier
+                ), reserved AS (
+                    INSERT INTO credit_reservations (user_id, telegram_id, amount)
+                    SELECT id, $1, $2 FROM charged
+                    RETURNING id
+                )
+                SELECT reserved.id AS reservation_id,
+                       charged.id, charged.balance, charged.total_generations, charged.preferred_tier
+                FROM charged, reserved
+            ''', telegram_id, amount)
+            if row:
+                self.users.put(telegram_id, row)
+                self.router.wrote(telegram_id)
+            return row
+    
+    @timed
+    async def settle_reservation(self, reservation_id):
+        """Закрытие резерва без записи в историю (её делает HistoryWriter).
+
+        Возвращает (user_id, telegram_id, amount, balance) или None, если резерва нет.
+        """
+        async with self.acquire() as conn:
+            row = await conn.fetchrow('''
+                WITH settled AS (
+                    DELETE FROM credit_reservations WHERE id = $1
+                    RETURNING user_id, telegram_id, amount
+                )
+                SELECT settled.user_id, settled.telegram_id, settled.amount, users.balance
+                FROM settled JOIN users ON users.id = settled.user_id
+            ''', reservation_id)
+            if row:
+                self.users.update(row['telegram_id'], balance=row['balance'])
+                self.router.wrote(row['telegram_id'])
+            return row
+    
+    @timed
+    async def release_reservation(self, reservation_id):
+        """Возврат резерва на баланс. Возвращает баланс или None, если резерва нет"""
+        async with self.acquire() as conn:
+            row = await conn.fetchrow('''
+                WITH released AS (
+                    DELETE FROM credit_reservations WHERE id = $1
+                    RETURNING user_id, amount
+                )
+                UPDATE users SET balance = balance + released.amount, last_active = NOW()
+                FROM released WHERE users.id = released.user_id
+                RETURNING users.telegram_id, users.id, users.balance, users.total_generations,
+                          users.preferred_tier
+            ''', reservation_id)
+            if not row:
+                return None
+            self.users.put(row['telegram_id'], row)
+            self.router.wrote(row['telegram_id'])
+            return row['balance']
+    
+    @timed
+    async def sweep_reservations(self, max_age_seconds):
+        """Возврат зависших резервов старше max_age_seconds. Возвращает число пользователей"""
+        async with self.acquire() as conn:
+            rows = await conn.fetch('''
+                WITH expired AS (
+                    DELETE FROM credit_reservations r
+                    WHERE r.created_at < NOW() - make_interval(secs => $1)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM jobs
+                          WHERE jobs.reservation_id = r.id AND jobs.state IN ('queued', 'running')
+                      )
+                    RETURNING r.user_id, r.amount
+                ), refund AS (
+                    SELECT user_id, SUM(amount) AS amount FROM expired GROUP BY user_id
+                )
+                UPDATE users SET balance = balance + refund.amount
+                FROM refund WHERE users.id = refund.user_id
+                RETURNING users.telegram_id, users.id, users.balance, users.total_generations,
+                          users.preferred_tier
+            ''', float(max_age_seconds))
+            for row in rows:
+                self.users.put(row['telegram_id'], row)
+                self.router.wrote(row['telegram_id'])
+            return len(rows)
+    
+    @timed
+    async def write_generations(self, records, columns):
+        """Пакетная запись истории: COPY строк и один UPDATE счётчиков на пачку"""
+        counts = Counter(record[columns.index('user_id')] for record in records)
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.copy_records_to_table('generations', records=records, columns=columns)
+                rows = await conn.fetch('''
+                    UPDATE users SET total_generations = total_generations + v.cnt
+                    FROM unnest($1::int[], $2::int[]) AS v(user_id, cnt)
+                    WHERE users.id = v.user_id
+                    RETURNING users.telegram_id, users.id, users.balance, users.total_generations,
+                              users.preferred_tier
+                ''', list(counts), list(counts.values()))
+        for row in rows:
+            self.users.put(row['telegram_id'], row)
+            self.router.wrote(row['telegram_id'])
+    
+    @timed
+    async def get_user_generations(self, telegram_id, limit=10, before=None, after=None):
+        """История с изображениями, новые первыми; keyset-пагинация по (created_at, id).
+
+        before / after — курсор (created_at, id): записи старше или новее него.
+        Стоимость страницы не зависит от её номера и размера истории; условие
+        на один created_at отсекает лишние месячные секции.
+        """
+        if after:
+            rows = await self._read(
+                'fetch', HISTORY_NEWER_SQL, telegram_id, after[0], after[1], limit, telegram_id=telegram_id
             )
-            if not user:
-                return
-            
+            return rows[::-1]
+        if before:
+            return await self._read(
+                'fetch', HISTORY_OLDER_SQL, telegram_id, before[0], before[1], limit, telegram_id=telegram_id
+            )
+        return await self._read('fetch', HISTORY_FIRST_PAGE_SQL, telegram_id, limit, telegram_id=telegram_id)
+    
+    @timed
+    async def find_cached_generation(self, cache_key, max_age_seconds):
+        """Последний результат с таким же ключом кэша, не старше max_age_seconds.
+
+        Читается с реплики: отстающая реплика даёт лишь промах кэша.
+        """
+        return await self._read('fetchrow', CACHED_GENERATION_SQL, cache_key, float(max_age_seconds))
+    
+    # ===== ОЧЕРЕДЬ ГЕНЕРАЦИЙ =====
+    @timed
+    async def enqueue_job(self, job, max_attempts, per_user_limit, queue_size):
+        """Постановка задачи с проверкой лимитов одним запросом.
+
+        Возвращает (id, queued, ready, mine): id = NULL, если лимит пользователя
+        или размер очереди превышены; queued — задач в очереди перед этой,
+        ready — из них готовых к запуску (без отложенных повторов).
+        """
+        async with self.acquire() as conn:
+            return await conn.fetchrow('''
+                WITH counts AS (
+                    SELECT COUNT(*) FILTER (WHERE state = 'queued') AS queued,
+                           COUNT(*) FILTER (WHERE state = 'queued' AND run_at <= NOW()) AS ready,
+                           COUNT(*) FILTER (WHERE telegram_id = $1) AS mine
+                    FROM jobs WHERE state IN ('queued', 'running')
+                ), job AS (
+                    INSERT INTO jobs (telegram_id, chat_id, prompt, cache_key, reservation_id,
+                                      variants, tier, max_attempts)
+                    SELECT $1, $2, $3, $4, $5, $6, $10, $7 FROM counts
+                    WHERE counts.mine < $8 AND counts.queued < $9
+                    RETURNING id
+                )
+                SELECT job.id, counts.queued, counts.ready, counts.mine FROM counts LEFT JOIN job ON TRUE
+            ''', job.telegram_id, job.chat_id, job.prompt, job.cache_key, job.reservation_id,
+                job.variants, max_attempts, per_user_limit, queue_size, job.tier)
+    
+    @timed
+    async def claim_jobs(self, limit, lease_seconds):
+        """Забрать до limit задач: готовые к запуску и с истёкшей арендой.
+
+        waited — сколько секунд задача ждала в очереди с момента, когда стала готова к запуску.
+        """
+        async with self.acquire() as conn:
+            return await conn.fetch('''
+                UPDATE jobs SET state = 'running',
+                                attempts = attempts + 1,
+                                lease_until = NOW() + make_interval(secs => $2)
+                WHERE id IN (
+                    SELECT id FROM jobs
+                    WHERE (state = 'queued' AND run_at <= NOW())
+                       OR (state = 'running' AND lease_until < NOW())
+                    ORDER BY run_at
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, telegram_id, chat_id, prompt, cache_key, reservation_id,
+                          variants, tier, attempts, max_attempts,
+                          EXTRACT(EPOCH FROM NOW() - run_at)::float8 AS waited
+            ''', limit, float(lease_seconds))
+    
+    @timed
+    async def extend_job_lease(self, job_id, lease_seconds):
+        async with self.acquire() as conn:
             await conn.execute('''
-                INSERT INTO generations 
-                (user_id, telegram_id, prompt, negative_prompt, image_url, telegram_file_id, cost)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-            ''', user['id'], telegram_id, prompt, negative_prompt, image_url, file_id, cost)
-            
+                UPDATE jobs SET lease_until = NOW() + make_interval(secs => $2)
+                WHERE id = $1 AND state = 'running'
+            ''', job_id, float(lease_seconds))
+    
+    @timed
+    async def complete_job(self, job_id):
+        async with self.acquire() as conn:
             await conn.execute('''
-                UPDATE users SET total_generations = total_generations + 1
-                WHERE telegram_id = $1
-            ''', telegram_id)
+                UPDATE jobs SET state = 'done', lease_until = NULL, finished_at = NOW()
+                WHERE id = $1
+            ''', job_id)
     
-    async def get_user_generations(self, telegram_id, limit=10):
-        async with self.pool.acquire() as conn:
-            return await conn.fetch('''
-                SELECT * FROM generations
-                WHERE telegram_id = $1
-                ORDER BY created_at DESC
-                LIMIT $2
-            ''', telegram_id, limit)
+    @timed
+    async def retry_job(self, job_id, error, delay_seconds):
+        async with self.acquire() as conn:
+            await conn.execute('''
+                UPDATE jobs SET state = 'queued',
+                                lease_until = NULL,
+                                last_error = $2,
+                                run_at = NOW() + make_interval(secs => $3)
+                WHERE id = $1
+            ''', job_id, error, float(delay_seconds))
     
-    async def create_purchase(self, telegram_id, package, amount_rub, credits_added, payment_id):
-        async with self.pool.acquire() as conn:
-            user = await conn.fetchrow(
-                'SELECT id FROM users WHERE telegram_id = $1',
-                telegram_id
+    @timed
+    async def fail_job(self, job_id, error):
+        async with self.acquire() as conn:
+            await conn.execute('''
+                UPDATE jobs SET state = 'failed', lease_until = NULL, last_error = $2, finished_at = NOW()
+                WHERE id = $1
+            ''', job_id, error)
+    
+    @timed
+    async def requeue_jobs(self, job_ids):
+        """Возврат прерванных остановкой задач; попытка не засчитывается"""
+        async with self.acquire() as conn:
+            await conn.execute('''
+                UPDATE jobs SET state = 'queued', lease_until = NULL, run_at = NOW(),
+                                attempts = GREATEST(attempts - 1, 0)
+                WHERE id = ANY($1::bigint[]) AND state = 'running'
+            ''', list(job_ids))
+    
+    @timed
+    async def sweep_jobs(self, max_age_seconds):
+        async with self.acquire() as conn:
+            await conn.execute('''
+                DELETE FROM jobs
+                WHERE state IN ('done', 'failed')
+                  AND finished_at < NOW() - make_interval(secs => $1)
+            ''', float(max_age_seconds))
+    
+    @timed
+    async def count_jobs(self):
+        """Число задач в очереди и в работе (для метрик)"""
+        async with self.acquire() as conn:
+            return await conn.fetchrow('''
+                SELECT COUNT(*) FILTER (WHERE state = 'queued') AS queued,
+                       COUNT(*) FILTER (WHERE state = 'running') AS running
+                FROM jobs WHERE state IN ('queued', 'running')
+            ''')
+    
+    # ===== РАССЫЛКИ =====
+    @timed
+    async def create_broadcast(self, text, chat_id):
+        """Черновик рассылки; total — сколько получателей сейчас (без заблокировавших бота)"""
+        async with self.acquire() as conn:
+            return await conn.fetchrow('''
+                INSERT INTO broadcasts (text, chat_id, total)
+                SELECT $1, $2, COUNT(*) FROM users WHERE blocked_at IS NULL
+                RETURNING id, total
+            ''', text, chat_id)
+    
+    @timed
+    async def start_broadcast(self, broadcast_id):
+        async with self.acquire() as conn:
+            return await conn.fetchval('''
+                UPDATE broadcasts SET state = 'running', updated_at = NOW()
+                WHERE id = $1 AND state = 'draft'
+                RETURNING id
+            ''', broadcast_id) is not None
+    
+    @timed
+    async def cancel_broadcast(self, broadcast_id):
+        """Остановка: выполняющий процесс заметит её на следующей контрольной точке"""
+        async with self.acquire() as conn:
+            return await conn.fetchval('''
+                UPDATE broadcasts SET state = 'canceled', finished_at = NOW()
+                WHERE id = $1 AND state IN ('draft', 'running')
+                RETURNING id
+            ''', broadcast_id) is not None
+    
+    @timed
+    async def claim_broadcast(self, owner, lease_seconds):
+        """Взять рассылку в работу, если никакая другая не выполняется.
+
+        Одновременно идёт одна рассылка на все реплики: лимит Telegram общий
+        для бота. Брошенная упавшим процессом подхватывается по истечении аренды.
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', BROADCAST_LOCK)
+                return await conn.fetchrow('''
+                    UPDATE broadcasts SET owner = $1, lease_until = NOW() + make_interval(secs => $2)
+                    WHERE id = (
+                        SELECT id FROM broadcasts
+                        WHERE state = 'running' AND (lease_until IS NULL OR lease_until < NOW())
+                        ORDER BY id
+                        LIMIT 1
+                    )
+                    AND NOT EXISTS (
+                        SELECT 1 FROM broadcasts WHERE state = 'running' AND lease_until >= NOW()
+                    )
+                    RETURNING id, text, chat_id, total, delivered, failed, blocked, last_user_id
+                ''', owner, float(lease_seconds))
+    
+    @timed
+    async def checkpoint_broadcast(self, broadcast_id, owner, last_user_id, delivered, failed, blocked,
+                                   blocked_user_ids, lease_seconds=None, finished=False):
+        """Прогресс рассылки одним запросом; продлевает аренду (lease_seconds=None — отпускает).
+
+        blocked_user_ids — заблокировавшие бота с прошлой точки: следующие
+        рассылки их пропускают, пока они снова не напишут /start.
+        Возвращает state или None, если рассылку забрал другой процесс.
+        """
+        async with self.acquire() as conn:
+            return await conn.fetchval('''
+                WITH gone AS (
+                    UPDATE users SET blocked_at = NOW() WHERE id = ANY($7::int[])
+                )
+                UPDATE broadcasts SET last_user_id = $3, delivered = $4, failed = $5, blocked = $6,
+                    updated_at = NOW(),
+                    lease_until = CASE WHEN $8::float8 IS NULL THEN NULL
+                                       ELSE NOW() + make_interval(secs => $8::float8) END,
+                    state = CASE WHEN $9 AND state = 'running' THEN 'done' ELSE state END,
+                    finished_at = CASE WHEN $9 AND state = 'running' THEN NOW() ELSE finished_at END
+                WHERE id = $1 AND owner = $2
+                RETURNING state
+            ''', broadcast_id, owner, last_user_id, delivered, failed, blocked,
+                list(blocked_user_ids), lease_seconds, finished)
+    
+    async def broadcast_recipients(self, after_user_id, limit, prefetch=200):
+        """Получатели после users.id = after_user_id по возрастанию id, не больше limit.
+
+        Серверный курсор на отдельном соединении: пул не занят на время
+        рассылки, в памяти не больше prefetch строк. Транзакция курсора живёт,
+        пока отправляется пачка, — поэтому limit небольшой.
+        """
+        conn = await asyncpg.connect(self._dsn, **self._ssl_kwargs)
+        try:
+            async with conn.transaction(readonly=True):
+                async for row in conn.cursor('''
+                    SELECT id, telegram_id FROM users
+                    WHERE id > $1 AND blocked_at IS NULL
+                    ORDER BY id
+                    LIMIT $2
+                ''', after_user_id, limit, prefetch=prefetch):
+                    yield row
+        finally:
+            await conn.close()
+    
+    # ===== СЕКЦИИ generations =====
+    @asynccontextmanager
+    async def advisory_lock(self, key, wait=False):
+        """pg_try_advisory_lock на отдельном соединении; внутри блока — True, если взяли.
+
+        wait=True — ждать, пока блокировку отпустит другая реплика.
+        """
+        async with self.acquire() as conn:
+            if wait:
+                locked = await conn.fetchval('SELECT pg_advisory_lock($1) IS NOT NULL', key)
+            else:
+                locked = await conn.fetchval('SELECT pg_try_advisory_lock($1)', key)
+            try:
+                yield locked
+            finally:
+                if locked:
+                    await conn.execute('SELECT pg_advisory_unlock($1)', key)
+    
+    @timed
+    async def ensure_generation_partitions(self, months_ahead=2):
+        """Секции generations на текущий месяц и months_ahead вперёд, плюс DEFAULT.
+
+        Месяцы, уже покрытые секцией (например, перенесённой старой таблицей),
+        пропускаются. Строки месяца, попавшие в DEFAULT, переносятся в новую
+        секцию; месяц, который создать не удалось, пропускается с ошибкой в
+        логе, остальные создаются. Возвращает имена созданных секций или None,
+        если таблица ещё не секционирована.
+        """
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                # Реплики стартуют одновременно: секции создаёт одна
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', PARTITIONS_LOCK)
+                if not await conn.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'generations'::regclass)"
+                ):
+                    return None
+                
+                existing = await self._generation_partitions(conn)
+                await conn.execute('CREATE TABLE IF NOT EXISTS generations_default PARTITION OF generations DEFAULT')
+                
+                created = []
+                now = datetime.now()
+                for offset in range(months_ahead + 1):
+                    start, end = month_start(now, offset), month_start(now, offset + 1)
+                    overlaps = any(
+                        p['attached'] and p['upper'] and (p['lower'] is None or p['lower'] < end) and start < p['upper']
+                        for p in existing
+                    )
+                    if overlaps:
+                        continue
+                    name = partition_name(start)
+                    try:
+                        # Точка сохранения: сбой одного месяца не откатывает остальные
+                        async with conn.transaction():
+                            await self._create_generation_partition(conn, name, start, end)
+                    except asyncpg.PostgresError as e:
+                        logger.error(f"❌ Секция {name} не создана: {e}")
+                        continue
+                    created.append(name)
+                return created
+    
+    async def _create_generation_partition(self, conn, name, start, end):
+        bounds = f"FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        in_default = await conn.fetchval(
+            'SELECT EXISTS (SELECT 1 FROM generations_default WHERE created_at >= $1 AND created_at < $2)',
+            start, end
+        )
+        if not in_default:
+            await conn.execute(f"CREATE TABLE {name} PARTITION OF generations FOR VALUES {bounds}")
+            return
+        # CREATE ... PARTITION OF отказывает, пока строки месяца лежат в DEFAULT:
+        # переносим их в отдельную таблицу и подключаем её секцией
+        await conn.execute(f"CREATE TABLE {name} (LIKE generations INCLUDING DEFAULTS)")
+        moved = await conn.execute(f'''
+            WITH moved AS (
+                DELETE FROM generations_default WHERE created_at >= $1 AND created_at < $2 RETURNING *
             )
-            if not user:
+            INSERT INTO {name} SELECT * FROM moved
+        ''', start, end)
+        await conn.execute(f"ALTER TABLE generations ATTACH PARTITION {name} FOR VALUES {bounds}")
+        logger.warning(f"⚠️ Секция {name}: перенесено из generations_default строк: {moved.split()[-1]}")
+    
+    @timed
+    async def generation_partitions(self):
+        """Секции generations с границами и отсоединённые, но ещё не выгруженные таблицы"""
+        async with self.acquire() as conn:
+            return await self._generation_partitions(conn)
+    
+    async def _generation_partitions(self, conn):
+        rows = await conn.fetch('''
+            SELECT c.relname AS name, c.relispartition AS attached,
+                   pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = current_schema()
+              AND c.relkind = 'r'
+              AND c.relname ~ '^generations_(y[0-9]{4}m[0-9]{2}|legacy)$'
+        ''')
+        partitions = []
+        for row in rows:
+            # FOR VALUES FROM ('2026-01-01 00:00:00') TO ('2026-02-01 00:00:00') или FROM (MINVALUE)
+            lower = upper = None
+            bounds = re.findall(r"\('([^']*)'\)|\((MINVALUE|MAXVALUE)\)", row['bound'] or '')
+            if len(bounds) == 2:
+                lower, upper = (datetime.fromisoformat(value) if value else None for value, _ in bounds)
+            partitions.append({'name': row['name'], 'attached': row['attached'], 'lower': lower, 'upper': upper})
+        return sorted(partitions, key=lambda p: p['upper'] or datetime.max)
+    
+    @timed
+    async def detach_generation_partition(self, name):
+        async with self.acquire() as conn:
+            await conn.execute(f'ALTER TABLE generations DETACH PARTITION "{name}"')
+    
+    @timed
+    async def export_table(self, name, output):
+        """COPY таблицы в CSV с заголовком; output — корутина, получающая куски байтов"""
+        async with self.acquire() as conn:
+            status = await conn.copy_from_table(name, output=output, format='csv', header=True)
+            return int(status.split()[-1])
+    
+    @timed
+    async def drop_table(self, name):
+        async with self.acquire() as conn:
+            await conn.execute(f'DROP TABLE "{name}"')
+    
+    # ===== АПДЕЙТЫ (вебхук, несколько реплик) =====
+    @timed
+    async def claim_update(self, update_id):
+        """True, если апдейт ещё никем не обработан и теперь закреплён за нами"""
+        async with self.acquire() as conn:
+            result = await conn.execute(
+                'INSERT INTO processed_updates (update_id) VALUES ($1) ON CONFLICT DO NOTHING',
+                update_id
+            )
+            return result == "INSERT 0 1"
+    
+    @timed
+    async def sweep_processed_updates(self, max_age_seconds):
+        async with self.acquire() as conn:
+            await conn.execute(
+                'DELETE FROM processed_updates WHERE received_at < NOW() - make_interval(secs => $1)',
+                float(max_age_seconds)
+            )
+    
+    @timed
+    async def ping(self):
+        async with self.acquire() as conn:
+            return await conn.fetchval('SELECT 1') == 1
+    
+    @timed
+    async def create_purchase(self, telegram_id, package, amount_rub, credits_added, payment_id):
+        async with self.acquire() as conn:
+            user_id = await self._user_id(conn, telegram_id)
+            if not user_id:
                 return
             
             await conn.execute('''
                 INSERT INTO purchases 
                 (user_id, telegram_id, package, amount_rub, credits_added, payment_id, status)
                 VALUES ($1, $2, $3, $4, $5, $6, $7)
-            ''', user['id'], telegram_id, package, amount_rub, credits_added, payment_id, 'pending')
+            ''', user_id, telegram_id, package, amount_rub, credits_added, payment_id, 'pending')
@@ -0,0 +1,163 @@
+# fake_replicate.py — локальная имитация API Replicate для офлайн-тестов задержек и нагрузки
+#
+#   python fake_replicate.py --port 9000 --latency 6 --jitter 3 --max-concurrency 50 \
+#       --model-latency black-forest-labs/flux-schnell=1.5
+#   REPLICATE_API_URL=http://localhost:9000/v1 python main.py
+#
+# Промпт со словом "nsfw" завершается ошибкой модерации, "fail" — обычной ошибкой.
+# Сверх --max-concurrency активных предсказаний сервер отвечает 429.
+import argparse
+import asyncio
+import random
+import struct
+import uuid
+import zlib
+
+import aiohttp
+from aiohttp import web
+
+
+def solid_png(width, height, rgb=(120, 80, 200)):
+    """Однотонный PNG без сторонних библиотек"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+class FakeReplicate:
+    def __init__(self, latency=6.0, jitter=3.0, max_concurrency=50, image_size=1024, model_latency=None):
+        self.latency = latency
+        self.model_latency = model_latency or {}  # "owner/name" -> средняя длительность, с
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.image = solid_png(image_size, image_size)
+        self.predictions = {}
+        self.active = 0
+        self.created = 0
+        self.rejected = 0
+        self.polls = 0
+        self._tasks = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1/models/{owner}/{name}/predictions", self.create)
+        app.router.add_get("/v1/predictions/{id}", self.get)
+        app.router.add_post("/v1/predictions/{id}/cancel", self.cancel)
+        app.router.add_get("/images/{name}", self.image_file)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    async def create(self, request):
+        if self.active >= self.max_concurrency:
+            self.rejected += 1
+            return web.json_response(
+                {"detail": "Request was throttled."}, status=429, headers={"Retry-After": "1"}
+            )
+
+        body = await request.json()
+        prediction_id = uuid.uuid4().hex
+        prediction = {
+            "id": prediction_id,
+            "model": f"{request.match_info['owner']}/{request.match_info['name']}",
+            "input": body.get("input", {}),
+            "status": "starting",
+            "output": None,
+            "error": None,
+        }
+        self.predictions[prediction_id] = prediction
+        self.active += 1
+        self.created += 1
+
+        origin = f"{request.scheme}://{request.host}"
+        task = asyncio.create_task(self._complete(prediction, body.get("webhook"), origin))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response(prediction, status=201)
+
+    async def get(self, request):
+        self.polls += 1
+        prediction = self.predictions.get(request.match_info["id"])
+        if not prediction:
+            return web.json_response({"detail": "Not found."}, status=404)
+        return web.json_response(prediction)
+
+    async def cancel(self, request):
+        prediction = self.predictions.get(request.match_info["id"])
+        if not prediction:
+            return web.json_response({"detail": "Not found."}, status=404)
+        if prediction["status"] in ("starting", "processing"):
+            prediction["status"] = "canceled"
+        return web.json_response(prediction)
+
+    async def image_file(self, request):
+        return web.Response(body=self.image, content_type="image/png")
+
+    async def stats(self, request):
+        return web.json_response({
+            "active": self.active,
+            "created": self.created,
+            "rejected": self.rejected,
+            "polls": self.polls,
+        })
+
+    async def _complete(self, prediction, webhook, origin):
+        try:
+            prediction["status"] = "processing"
+            latency = self.model_latency.get(prediction["model"], self.latency)
+            await asyncio.sleep(max(0.0, random.gauss(latency, self.jitter / 2)))
+            if prediction["status"] == "canceled":
+                return
+
+            prompt = str(prediction["input"].get("prompt", "")).lower()
+            if "nsfw" in prompt:
+                prediction["status"] = "failed"
+                prediction["error"] = "NSFW content detected. Try running it again, or try a different prompt."
+            elif "fail" in prompt:
+                prediction["status"] = "failed"
+                prediction["error"] = "CUDA out of memory"
+            else:
+                count = int(prediction["input"].get("num_outputs", 1))
+                prediction["status"] = "succeeded"
+                prediction["output"] = [
+                    f"{origin}/images/{prediction['id']}_{n}.png" for n in range(count)
+                ]
+        finally:
+            self.active -= 1
+
+        if webhook:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    await session.post(webhook, json=prediction)
+            except aiohttp.ClientError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная имитация API Replicate")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=6.0, help="средняя длительность генерации, с")
+    parser.add_argument("--jitter", type=float, default=3.0, help="разброс длительности, с")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="OWNER/NAME=SECONDS",
+                        help="своя средняя длительность для модели, например быстрого уровня")
+    parser.add_argument("--max-concurrency", type=int, default=50)
+    parser.add_argument("--image-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    model_latency = {}
+    for item in args.model_latency:
+        model, _, seconds = item.rpartition("=")
+        model_latency[model] = float(seconds)
+    fake = FakeReplicate(args.latency, args.jitter, args.max_concurrency, args.image_size, model_latency)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
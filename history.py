@@ -0,0 +1,143 @@
+# history.py — отложенная пакетная запись истории генераций (write-behind через COPY)
+import asyncio
+import logging
+import time
+
+from metrics import HISTORY_BATCH_SIZE, HISTORY_DROPPED, HISTORY_FLUSH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Порядок полей записи = порядок колонок для copy_records_to_table
+GENERATION_COLUMNS = (
+    'user_id', 'telegram_id', 'prompt', 'negative_prompt',
+    'image_url', 'telegram_file_id', 'cost', 'cache_key', 'tier'
+)
+
+
+class HistoryWriter:
+    """Буфер записей generations со сбросом по размеру или по времени.
+
+    Пользователь не ждёт запись истории: add() кладёт запись в память,
+    фоновая задача пишет пачку одним COPY и одним UPDATE счётчиков.
+    Буфер ограничен — при переполнении add() ждёт сброса; если БД
+    недоступна, самые старые записи теряются (dropped).
+    """
+
+    def __init__(self, db, batch_size=500, flush_interval=1.0, max_buffer=10000):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.flushes = 0
+        self.records_written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="history-writer")
+
+    async def stop(self):
+        """Остановка с финальным сбросом буфера"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._buffer:
+            logger.error(f"❌ История: не записано {len(self._buffer)} записей при остановке")
+
+    async def add(self, user_id, telegram_id, prompt, image_url=None, file_id=None,
+                  cost=1, negative_prompt=None, cache_key=None, tier=None):
+        await self.add_many(
+            user_id, telegram_id, prompt, [(image_url, file_id)],
+            cost=cost, negative_prompt=negative_prompt, cache_key=cache_key, tier=tier
+        )
+
+    async def add_many(self, user_id, telegram_id, prompt, images, cost=1,
+                       negative_prompt=None, cache_key=None, tier=None):
+        """Несколько изображений одного промпта; images — [(image_url, file_id)].
+
+        Строки попадают в буфер разом и уходят одним COPY.
+        """
+        if len(self._buffer) + len(images) > self.max_buffer:
+            await self.flush()
+            # Сброс не удался — место освобождаем за счёт самых старых записей
+            self._drop_oldest(len(self._buffer) + len(images) - self.max_buffer)
+
+        self._buffer.extend(
+            (user_id, telegram_id, prompt, negative_prompt, image_url, file_id, cost, cache_key, tier)
+            for image_url, file_id in images
+        )
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+
+            started = time.perf_counter()
+            try:
+                await self.db.write_generations(batch, GENERATION_COLUMNS)
+            except asyncio.CancelledError:
+                self._buffer = batch + self._buffer
+                raise
+            except Exception as e:
+                self.failed_flushes += 1
+                # Возвращаем пачку в начало буфера, лишнее сверх лимита теряем
+                self._buffer = batch + self._buffer
+                self._drop_oldest(len(self._buffer) - self.max_buffer)
+                logger.error(f"❌ Ошибка записи истории ({len(batch)} записей): {e}")
+                return
+
+            elapsed = time.perf_counter() - started
+            self.flushes += 1
+            self.records_written += len(batch)
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+            HISTORY_FLUSH_SECONDS.observe(elapsed)
+            HISTORY_BATCH_SIZE.observe(len(batch))
+
+    def _drop_oldest(self, count):
+        if count > 0:
+            del self._buffer[:count]
+            self.dropped += count
+            HISTORY_DROPPED.inc(amount=count)
+
+    def stats(self):
+        return {
+            "buffered": len(self._buffer),
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "records_written": self.records_written,
+            "dropped": self.dropped,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": self.records_written / self.flushes if self.flushes else 0.0,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "avg_flush_seconds": self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
@@ -0,0 +1,164 @@
+# imaging.py — постобработка результата: загрузка байтов и JPEG-превью в пуле процессов
+import asyncio
+import importlib.util
+import io
+import logging
+import os
+import time
+
+import aiohttp
+
+from metrics import IMAGE_STAGE_SECONDS, span
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores():
+    """Ядра, доступные процессу (учитывает taskset/cgroup cpuset)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def render_preview(data, max_side=1280, quality=85):
+    """Выполняется в процессе пула: JPEG-превью не больше max_side по длинной стороне.
+
+    Возвращает (jpeg, width, height) исходного изображения.
+    """
+    from PIL import Image  # Pillow нужен только процессам пула
+
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        image.draft("RGB", (max_side, max_side))  # для JPEG декодирует сразу в уменьшенном виде
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue(), width, height
+
+
+def _warm_up():
+    from PIL import Image  # noqa: F401 — импорт заранее, а не на первой картинке
+    return os.getpid()
+
+
+def _pool_context():
+    """forkserver: процессы пула — форки сервера, где модули уже импортированы.
+
+    multiprocessing заново выполняет main.py в каждом процессе пула (preload
+    "__main__" до Python 3.13 не срабатывает), поэтому сервер заранее загружает
+    и модули, импортированные в __main__: повторное выполнение — десятки
+    миллисекунд, а не секунды импорта aiogram. Где forkserver нет — spawn.
+    """
+    import multiprocessing
+    import sys
+    import types
+
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    preload = ["__main__", "imaging", "PIL.Image"]
+    for value in vars(sys.modules["__main__"]).values():
+        name = value.__name__ if isinstance(value, types.ModuleType) else getattr(value, "__module__", None)
+        if isinstance(name, str) and name in sys.modules and name not in preload:
+            preload.append(name)
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(preload)
+    return context
+
+
+class ImagePipeline:
+    """Скачивает результат генерации один раз и готовит превью вне event loop.
+
+    Пул процессов (forkserver) размером с число доступных ядер: декодирование и
+    кодирование JPEG держат GIL, поэтому потоки здесь не помогают.
+    processes — сколько процессов бота делят эти ядра (WEBHOOK_WORKERS):
+    каждому достаётся своя доля. Без Pillow пайплайн выключается, и бот
+    отправляет ссылку, как раньше.
+    """
+
+    def __init__(self, workers=None, max_side=1280, quality=85, max_bytes=30 * 1024 * 1024, processes=1):
+        self.workers = workers or max(1, available_cores() // max(1, processes))
+        self.max_side = max_side
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self.executor = None
+        self.session = None
+
+        self.processed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def start(self):
+        if importlib.util.find_spec("PIL") is None:
+            logger.warning("⚠️ Pillow не установлен — постобработка изображений выключена")
+            return
+        from concurrent.futures import ProcessPoolExecutor
+
+        context = _pool_context()
+        if context.get_start_method() == "forkserver":
+            from multiprocessing import forkserver
+
+            # Запуск сервера ждёт импорта модулей — секунды, не в event loop
+            await asyncio.to_thread(forkserver.ensure_running)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        loop = asyncio.get_running_loop()
+        # Процессы стартуют заранее, а не на первой генерации
+        await asyncio.gather(*(loop.run_in_executor(self.executor, _warm_up) for _ in range(self.workers)))
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        self.enabled = True
+        logger.info(f"✅ Постобработка изображений: {self.workers} процессов")
+
+    async def stop(self):
+        self.enabled = False
+        if self.session:
+            await self.session.close()
+            self.session = None
+        if self.executor:
+            # Ожидание процессов пула — в потоке, чтобы не останавливать event loop
+            await asyncio.to_thread(self.executor.shutdown, wait=True, cancel_futures=True)
+            self.executor = None
+
+    async def download(self, url):
+        """Байты изображения; один буфер без промежуточных копий"""
+        with IMAGE_STAGE_SECONDS.time("download"), span("image.download"):
+            async with self.session.get(url) as response:
+                response.raise_for_status()
+                if response.content_length is not None:
+                    if response.content_length > self.max_bytes:
+                        raise ValueError(f"image too large: {response.content_length} bytes")
+                    data = await response.read()
+                else:
+                    # Без Content-Length (chunked) лимит проверяем по мере чтения
+                    buffer = bytearray()
+                    async for chunk in response.content.iter_chunked(256 * 1024):
+                        buffer += chunk
+                        if len(buffer) > self.max_bytes:
+                            raise ValueError(f"image too large: over {self.max_bytes} bytes")
+                    data = bytes(buffer)
+        self.bytes_in += len(data)
+        return data
+
+    async def preview(self, data):
+        """(jpeg, width, height) — в пуле процессов, event loop не блокируется"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        with span("image.render"):
+            result = await loop.run_in_executor(
+                self.executor, render_preview, data, self.max_side, self.quality
+            )
+        IMAGE_STAGE_SECONDS.observe(time.perf_counter() - started, "render")
+        self.processed += 1
+        self.bytes_out += len(result[0])
+        return result
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "workers": self.workers,
+            "processed": self.processed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
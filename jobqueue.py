@@ -0,0 +1,199 @@
+# jobqueue.py — очередь генераций в Postgres: переживает перезапуск, задачи берёт любая реплика
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from scheduler import QueueFullError, UserLimitError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GenerationJob:
+    telegram_id: int
+    chat_id: int
+    prompt: str
+    cache_key: str = None
+    reservation_id: int = None
+    variants: int = 1
+    tier: str = None
+    waited: float = 0.0  # секунд в очереди до начала выполнения
+    id: int = None
+    attempts: int = 1
+    max_attempts: int = 1
+
+    @classmethod
+    def from_record(cls, row):
+        return cls(
+            id=row['id'],
+            telegram_id=row['telegram_id'],
+            chat_id=row['chat_id'],
+            prompt=row['prompt'],
+            cache_key=row['cache_key'],
+            reservation_id=row['reservation_id'],
+            variants=row['variants'],
+            tier=row['tier'],
+            waited=row['waited'],
+            attempts=row['attempts'],
+            max_attempts=row['max_attempts']
+        )
+
+
+class JobQueue:
+    """Воркеры забирают задачи через FOR UPDATE SKIP LOCKED с арендой (lease).
+
+    Пока задача выполняется, аренда продлевается. Если процесс упал, аренда
+    истекает и задачу забирает другой воркер. Ошибка — повтор с экспоненциальной
+    задержкой; после max_attempts или неповторяемой ошибки задача помечается
+    failed и вызывается on_failure (сообщение пользователю и возврат кредитов).
+    """
+
+    def __init__(self, db, handler, on_failure, workers=8, queue_size=200, per_user_limit=2,
+                 lease=120, max_attempts=3, retry_base=5, retry_max=300, poll_interval=1.0,
+                 retryable=None):
+        self.db = db
+        self.handler = handler
+        self.on_failure = on_failure
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_user_limit = per_user_limit
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.poll_interval = poll_interval
+        self.retryable = retryable or (lambda error: True)
+
+        self._running = {}  # job id -> task
+        # Оценка глубины общей очереди: по последней постановке и выборке задач
+        self.queued = 0
+        self._wakeup = asyncio.Event()
+        self._poller = None
+
+        self.claimed = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        self._poller = asyncio.create_task(self._poll(), name="job-poller")
+        logger.info(f"✅ Очередь задач в БД запущена: {self.workers} воркеров")
+
+    async def stop(self, drain_timeout=30):
+        """Остановка: ждём текущие задачи, недоделанные возвращаем в очередь"""
+        if self._poller:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+        if self._running:
+            await asyncio.wait(list(self._running.values()), timeout=drain_timeout)
+        unfinished = list(self._running)
+        for task in self._running.values():
+            task.cancel()
+        await asyncio.gather(*self._running.values(), return_exceptions=True)
+        if unfinished:
+            await self.db.requeue_jobs(unfinished)
+            logger.warning(f"⚠️ Возвращено в очередь при остановке: {len(unfinished)} задач")
+
+    async def enqueue(self, job):
+        """Запись задачи в БД. Возвращает позицию в очереди (0 — начнётся сразу)"""
+        row = await self.db.enqueue_job(
+            job,
+            max_attempts=self.max_attempts,
+            per_user_limit=self.per_user_limit,
+            queue_size=self.queue_size
+        )
+        if row['id'] is None:
+            if row['mine'] >= self.per_user_limit:
+                raise UserLimitError(job.telegram_id)
+            raise QueueFullError(self.queue_size)
+
+        job.id = row['id']
+        self._wakeup.set()
+        self.queued = row['queued'] + 1
+        # Как GenerationScheduler.submit: отложенные повторы впереди не стоят,
+        # а свободные воркеры этого процесса заберут задачу сразу
+        idle = self.workers - self.in_flight
+        return max(row['ready'] + 1 - idle, 0)
+
+    @property
+    def in_flight(self):
+        return len(self._running)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    async def _poll(self):
+        while True:
+            free = self.workers - len(self._running)
+            claimed = []
+            if free > 0:
+                try:
+                    claimed = await self.db.claim_jobs(free, self.lease)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка получения задач: {e}")
+
+            for row in claimed:
+                job = GenerationJob.from_record(row)
+                self._running[job.id] = asyncio.create_task(self._run(job), name=f"job-{job.id}")
+            self.claimed += len(claimed)
+            # Меньше, чем просили — готовых задач в очереди не осталось
+            self.queued = 0 if len(claimed) < free else max(self.queued - len(claimed), 0)
+
+            # Забрали всё, что было — ждём новую задачу или освобождения воркера
+            if len(claimed) < free or free <= 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _run(self, job):
+        heartbeat = asyncio.create_task(self._heartbeat(job.id))
+        try:
+            if job.attempts > job.max_attempts:
+                # Аренда истекала слишком много раз — процесс падает на этой задаче
+                raise RuntimeError("превышено число попыток (истекла аренда)")
+            await self.handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._handle_error(job, e)
+        else:
+            await self.db.complete_job(job.id)
+            self.completed += 1
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job.id, None)
+            self._wakeup.set()
+
+    async def _handle_error(self, job, error):
+        if job.attempts < job.max_attempts and self.retryable(error):
+            delay = min(self.retry_base * 2 ** (job.attempts - 1), self.retry_max)
+            await self.db.retry_job(job.id, str(error)[:500], delay)
+            self.retried += 1
+            logger.warning(f"⚠️ Задача {job.id}: попытка {job.attempts} неудачна, повтор через {delay} с: {error}")
+            return
+
+        await self.db.fail_job(job.id, str(error)[:500])
+        self.failed += 1
+        logger.error(f"❌ Задача {job.id} завершилась ошибкой: {error}")
+        try:
+            await self.on_failure(job, error)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки сбоя задачи {job.id}: {e}", exc_info=True)
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.db.extend_job_lease(job_id, self.lease)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось продлить аренду задачи {job_id}: {e}")
@@ -18,3 +18,39 @@ def get_buy_keyboard():
         [InlineKeyboardButton(text="🚀 Про — 200 генераций (999₽)", callback_data="buy_200")],
         [InlineKeyboardButton(text="🔙 Отмена", callback_data="cancel")]
     ])
+
+def get_batch_keyboard(sizes, cost):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"🎲 {size} варианта — {size * cost} генерации", callback_data=f"batch_{size}")]
+        for size in sizes
+    ])
+
+def get_tier_keyboard(tiers, current=None):
+    """Выбор уровня модели; current — имя выбранного уровня"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"{'✅ ' if tier.name == current else ''}{tier.title} — {tier.cost} генерация",
+            callback_data=f"tier_{tier.name}"
+        )]
+        for tier in tiers
+    ])
+
+def get_history_keyboard(newer=None, older=None):
+    """newer / older — курсоры соседних записей истории (или None, если их нет)"""
+    buttons = []
+    if newer:
+        buttons.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"hist_new_{newer}"))
+    if older:
+        buttons.append(InlineKeyboardButton(text="Старше ➡️", callback_data=f"hist_old_{older}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons] if buttons else [])
+
+def get_broadcast_keyboard(broadcast_id, running=False):
+    """Черновик рассылки — отправить или отменить; идущая — только остановить"""
+    stop = InlineKeyboardButton(
+        text="⏹ Остановить" if running else "❌ Отмена", callback_data=f"bcast_stop_{broadcast_id}"
+    )
+    if running:
+        return InlineKeyboardMarkup(inline_keyboard=[[stop]])
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📣 Отправить", callback_data=f"bcast_go_{broadcast_id}"), stop]
+    ])
@@ -1,18 +1,41 @@
 # main.py
 import asyncio
+import html
 import logging
-import replicate
 import os
-from aiogram import Bot, Dispatcher
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+import time
+from datetime import datetime
+from functools import partial
+from aiogram import Bot, Dispatcher, F
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, CallbackQuery, BufferedInputFile, InputMediaPhoto
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
 
 from config import *
 from database import Database
+from migrations import migrate
 from keyboards import *
+from cache import ResultCache, make_cache_key
+from singleflight import SingleFlight
+from history import HistoryWriter
+from middlewares import (
+    UpdateDedupMiddleware, UpdateTraceMiddleware, HandlerTimingMiddleware, RequestTimingMiddleware,
+    RateLimitMiddleware
+)
+from ratelimit import AdaptiveLimiter
+from imaging import ImagePipeline
+from partitions import PartitionMaintenance
+import metrics
+from metrics import GENERATION_BACKEND_SECONDS, span, trace
+from jobqueue import GenerationJob, JobQueue
+from replicate_client import (
+    ReplicateClient, ContentFlaggedError, RateLimitError, PredictionTimeoutError
+)
+from scheduler import GenerationScheduler, QueueFullError, UserLimitError
+from tiers import ModelTier, TierRouter
+from broadcast import Broadcaster
 
 # Настройка логирования
 logging.basicConfig(
@@ -29,7 +52,73 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 dp = Dispatcher()
-db = Database()
+db = Database(
+    user_cache_size=USER_CACHE_SIZE,
+    pool_min_size=DB_POOL_MIN_SIZE,
+    pool_max_size=DB_POOL_MAX_SIZE,
+    replica_max_lag=REPLICA_MAX_LAG,
+    read_your_writes=REPLICA_READ_YOUR_WRITES
+)
+scheduler = GenerationScheduler(
+    workers=GENERATION_WORKERS,
+    queue_size=GENERATION_QUEUE_SIZE,
+    per_user_limit=MAX_JOBS_PER_USER
+)
+# Колбэк о завершении генерации приходит на тот же HTTP-сервер, что и вебхук Telegram
+replicate_client = ReplicateClient(
+    REPLICATE_API_KEY,
+    base_url=REPLICATE_API_URL,
+    timeout=REPLICATE_TIMEOUT,
+    poll_min=REPLICATE_POLL_MIN,
+    poll_max=REPLICATE_POLL_MAX,
+    pool_size=REPLICATE_POOL_SIZE,
+    webhook_url=(
+        WEBHOOK_URL.rstrip('/') + REPLICATE_WEBHOOK_PATH
+        if BOT_MODE == "webhook" and WEBHOOK_URL else None
+    )
+)
+# Сколько генераций одновременно отправлять в Replicate: подстраивается по ответам 429
+backend_limiter = AdaptiveLimiter(
+    initial=BACKEND_CONCURRENCY_INITIAL,
+    min_limit=BACKEND_CONCURRENCY_MIN,
+    max_limit=BACKEND_CONCURRENCY_MAX,
+    overload_errors=(RateLimitError,)
+)
+# Уровни моделей: пользователь выбирает в /model, при длинной очереди — быстрый
+tier_router = TierRouter(
+    [
+        ModelTier("fast", "⚡ Быстрая", REPLICATE_FAST_MODEL,
+                  TIER_FAST_COST, TIER_FAST_LATENCY, TIER_FAST_CONCURRENCY),
+        ModelTier("quality", "🎨 Качественная", REPLICATE_MODEL,
+                  TIER_QUALITY_COST, TIER_QUALITY_LATENCY, TIER_QUALITY_CONCURRENCY),
+    ],
+    default=DEFAULT_TIER,
+    fallback="fast",
+    max_wait=TIER_MAX_WAIT,
+    horizon=TIER_WAIT_HORIZON
+)
+TIER_FALLBACK_NOTICE = "⚡ Очередь большая — генерирую быстрой моделью"
+result_cache = ResultCache(db, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL)
+generation_flights = SingleFlight()
+partitions = PartitionMaintenance(
+    db,
+    retention_months=GENERATIONS_RETENTION_MONTHS,
+    archive_dir=GENERATIONS_ARCHIVE_DIR,
+    months_ahead=GENERATIONS_PARTITIONS_AHEAD
+)
+images = ImagePipeline(
+    workers=IMAGE_WORKERS or None,
+    max_side=IMAGE_PREVIEW_SIZE,
+    quality=IMAGE_PREVIEW_QUALITY,
+    # Процессы webhook делят ядра машины: у каждого своя доля пула
+    processes=WEBHOOK_WORKERS if BOT_MODE == "webhook" else 1
+)
+history = HistoryWriter(
+    db,
+    batch_size=HISTORY_BATCH_SIZE,
+    flush_interval=HISTORY_FLUSH_INTERVAL,
+    max_buffer=HISTORY_MAX_BUFFER
+)
 
 # ===== КОМАНДА /start =====
 @dp.message(Command("start"))
@@ -66,88 +155,444 @@ async def cmd_start(message: Message):
     await message.answer(welcome_text, reply_markup=get_main_keyboard())
 
 # ===== ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЯ (любой текст) =====
-@dp.message()
+# Команды не перехватываем: фильтр пропускает их к обработчикам ниже
+@dp.message(F.text, ~F.text.startswith('/'))
 async def generate_image(message: Message):
-    # Игнорируем команды и служебные сообщения
-    if message.text and message.text.startswith('/'):
-        return
-    
     user_id = message.from_user.id
     prompt = message.text.strip()
     
-    # Проверяем баланс
-    balance = await db.get_balance(user_id)
-    if balance < COST_STANDARD:
+    # Минимальная длина промпта
+    if len(prompt) < 5:
+        await message.answer("❌ Промпт слишком короткий! Напишите подробнее (минимум 5 символов).")
+        return
+    
+    # Строка пользователя обычно уже в кэше
+    user = await db.get_user(user_id)
+    tier = tier_router.get(user['preferred_tier'] if user else None) or tier_router.default
+    fell_back = False
+    
+    # Повторный промпт — отправляем готовый file_id без генерации
+    cache_key = make_cache_key(prompt, tier.model, DEFAULT_ASPECT_RATIO, DEFAULT_OUTPUT_FORMAT)
+    cached = await result_cache.get(cache_key)
+    if cached and not CACHE_CHARGE_HITS:
+        await send_cached_result(message, prompt, cache_key, cached, tier, user=user)
+        return
+    
+    # Промах: уровень выбирается по нагрузке (при длинной очереди — быстрый).
+    # Попадания в кэш до бэкенда не доходят и в метрики выбора уровня не попадают
+    if not cached:
+        tier, fell_back = choose_tier(user)
+        cache_key = make_cache_key(prompt, tier.model, DEFAULT_ASPECT_RATIO, DEFAULT_OUTPUT_FORMAT)
+    
+    # Заведомо пустой баланс отсекаем без запроса на списание
+    if user and user['balance'] < tier.cost:
         await message.answer(
             "❌ У вас закончились генерации!\nПополните баланс: /buy",
             reply_markup=get_buy_keyboard()
         )
         return
     
-    # Минимальная длина промпта
-    if len(prompt) < 5:
-        await message.answer("❌ Промпт слишком короткий! Напишите подробнее (минимум 5 символов).")
+    # Резервируем кредиты: проверка баланса и списание одним запросом
+    reservation = await db.reserve_credits(user_id, tier.cost)
+    if not reservation:
+        await message.answer(
+            "❌ У вас закончились генерации!\nПополните баланс: /buy",
+            reply_markup=get_buy_keyboard()
+        )
         return
+    reservation_id = reservation['reservation_id']
     
-    # Индикатор "печатает..."
-    await bot.send_chat_action(message.chat.id, "upload_photo")
+    if cached:
+        await send_cached_result(message, prompt, cache_key, cached, tier, reservation_id)
+        return
     
+    # Постановка в очередь генераций
+    job = GenerationJob(
+        telegram_id=user_id,
+        chat_id=message.chat.id,
+        prompt=prompt,
+        cache_key=cache_key,
+        reservation_id=reservation_id,
+        tier=tier.name
+    )
+    await submit_job(message, job, notice=TIER_FALLBACK_NOTICE if fell_back else None)
+
+def choose_tier(user):
+    """Уровень для новой генерации: (ModelTier, переключён ли на быстрый из-за очереди)"""
+    queued = job_queue.queued if DURABLE_JOBS else scheduler.depth
+    return tier_router.choose(user['preferred_tier'] if user else None, queued)
+
+async def submit_job(message: Message, job: GenerationJob, notice=None):
+    """Задача в очередь; при отказе резерв возвращается"""
     try:
-        # Генерация через Replicate
-        image_url = await generate_with_replicate(prompt)
-        
-        # Отправка изображения
-        sent_msg = await bot.send_photo(
-            chat_id=message.chat.id,
-            photo=image_url,
-            caption=(
-                f"✅ <b>Готово!</b>\n\n"
-                f"📝 Промпт: <code>{prompt[:60]}...</code>\n"
-                f"💰 Потрачено: {COST_STANDARD} генерация"
+        if DURABLE_JOBS:
+            position = await job_queue.enqueue(job)
+        else:
+            position = scheduler.submit(
+                job.telegram_id, partial(run_job_in_memory, job, time.monotonic())
             )
+    except UserLimitError:
+        await db.release_reservation(job.reservation_id)
+        await message.answer(
+            f"⏳ У вас уже {MAX_JOBS_PER_USER} генерации в работе. Дождитесь результата."
         )
-        
-        # Списание кредитов
-        success = await db.deduct_credits(user_id, COST_STANDARD)
-        
-        if success:
-            # Сохранение в историю
-            await db.save_generation(
-                telegram_id=user_id,
-                prompt=prompt,
-                image_url=image_url,
-                file_id=sent_msg.photo[-1].file_id,
-                cost=COST_STANDARD
-            )
-            
-            # Обновление баланса
-            new_balance = await db.get_balance(user_id)
-            await message.answer(
-                f"💰 <b>Ваш баланс:</b> {new_balance} генераций",
-                reply_markup=get_main_keyboard()
+        return
+    except QueueFullError:
+        await db.release_reservation(job.reservation_id)
+        await message.answer("⏳ Сервис перегружен. Попробуйте через минуту.")
+        return
+    
+    lines = [notice] if notice else []
+    if position:
+        lines.append(f"🕐 Вы #{position} в очереди")
+    if lines:
+        await message.answer("\n".join(lines))
+
+def result_caption(prompt: str, cost: int) -> str:
+    return (
+        f"✅ <b>Готово!</b>\n\n"
+        f"📝 Промпт: <code>{prompt[:60]}...</code>\n"
+        f"💰 Потрачено: {cost} генерация"
+    )
+
+async def answer_balance(chat_id: int, balance):
+    if balance is None:
+        await bot.send_message(chat_id, "⚠️ Ошибка при списании. Обратитесь в поддержку.")
+        return
+    
+    await bot.send_message(
+        chat_id,
+        f"💰 <b>Ваш баланс:</b> {balance} генераций",
+        reply_markup=get_main_keyboard()
+    )
+
+async def send_cached_result(message: Message, prompt: str, cache_key: str, cached, tier,
+                             reservation_id=None, user=None):
+    """Попадание в кэш: повторная отправка file_id, без вызова модели и загрузки.
+
+    Без резерва (бесплатное попадание) нужна строка пользователя user — для истории.
+    """
+    cost = tier.cost if reservation_id else 0
+    
+    try:
+        await bot.send_photo(
+            chat_id=message.chat.id,
+            photo=cached.file_id,
+            caption=result_caption(prompt, cost)
+        )
+    except Exception:
+        if reservation_id:
+            await db.release_reservation(reservation_id)
+        raise
+    
+    if not reservation_id:
+        # История — через ту же отложенную запись, что и у платных генераций
+        if user:
+            await history.add(
+                user['id'],
+                message.from_user.id,
+                prompt,
+                image_url=cached.image_url,
+                file_id=cached.file_id,
+                cost=0,
+                cache_key=cache_key,
+                tier=tier.name
             )
+        return
+    
+    new_balance = await record_generation(
+        reservation_id,
+        prompt=prompt,
+        image_url=cached.image_url,
+        file_id=cached.file_id,
+        cache_key=cache_key,
+        tier=tier.name
+    )
+    await answer_balance(message.chat.id, new_balance)
+
+async def process_generation(job: GenerationJob):
+    """Генерация по задаче из очереди; ошибку обрабатывает вызывающий"""
+    # Задачи, поставленные до появления уровней, идут на уровень по умолчанию
+    tier = tier_router.get(job.tier) or tier_router.default
+    with trace(f"генерация {job.id or job.cache_key[:8]} (пользователь {job.telegram_id})", TRACE_SLOW_SECONDS):
+        if job.variants > 1:
+            await _process_batch(job, tier)
         else:
-            await message.answer("⚠️ Ошибка при списании. Обратитесь в поддержку.")
-            
-    except Exception as e:
-        error = str(e).lower()
+            await _process_generation(job, tier)
+
+async def _process_generation(job: GenerationJob, tier: ModelTier):
+    # Индикатор "печатает..."
+    await bot.send_chat_action(job.chat_id, "upload_photo")
+    started = time.monotonic()
+    
+    # Генерация через Replicate: одинаковые одновременные промпты ждут один вызов
+    # (и одну загрузку с обработкой), но отправка, списание и возврат остаются
+    # у каждого пользователя свои
+    image_url, original, preview = await generation_flights.do(
+        job.cache_key, partial(generate_and_render, job.prompt, tier, job.waited)
+    )
+    
+    # Отправка изображения
+    sent_msg = await send_result(
+        job.chat_id, image_url, original, preview,
+        caption=result_caption(job.prompt, tier.cost)
+    )
+    
+    # Изображение доставлено: дальше ошибки только логируем — повтор задачи означал бы
+    # новую платную генерацию и второе фото. Незакрытый резерв вернёт housekeeping
+    try:
+        photo = sent_msg.photo[-1]
+        result_cache.put(job.cache_key, photo.file_id, image_url, photo.file_size, time.monotonic() - started)
         
-        if "nsfw" in error or "inappropriate" in error:
-            await message.answer(
-                "❌ Контент распознан как неприемлемый.\n"
-                "Измените промпт и попробуйте снова."
+        # Закрытие резерва; история пишется в фоне
+        new_balance = await record_generation(
+            job.reservation_id,
+            prompt=job.prompt,
+            image_url=image_url,
+            file_id=photo.file_id,
+            cache_key=job.cache_key,
+            tier=tier.name
+        )
+        await answer_balance(job.chat_id, new_balance)
+    except Exception as e:
+        logger.error(f"❌ Генерация доставлена, но не записана (резерв {job.reservation_id}): {e}", exc_info=True)
+
+async def _process_batch(job: GenerationJob, tier: ModelTier):
+    """Пакет: одно предсказание на N вариантов, одна медиагруппа, одно закрытие резерва"""
+    await bot.send_chat_action(job.chat_id, "upload_photo")
+    
+    variants = await generation_flights.do(
+        f"{job.cache_key}:{job.variants}",
+        partial(generate_variants_and_render, job.prompt, job.variants, tier, job.waited)
+    )
+    
+    caption = result_caption(job.prompt, tier.cost * job.variants)
+    media = [
+        InputMediaPhoto(
+            media=BufferedInputFile(preview, filename=f"variant_{n + 1}.jpg") if preview else image_url,
+            caption=caption if n == 0 else None
+        )
+        for n, (image_url, preview) in enumerate(variants)
+    ]
+    sent_messages = await bot.send_media_group(job.chat_id, media)
+    
+    # Как и для одной генерации, после доставки задачу не повторяем
+    try:
+        # Все N строк истории уходят одним COPY
+        new_balance = await record_generations(
+            job.reservation_id,
+            prompt=job.prompt,
+            images=[
+                (image_url, sent.photo[-1].file_id)
+                for (image_url, _), sent in zip(variants, sent_messages)
+            ],
+            cache_key=job.cache_key,
+            tier=tier.name
+        )
+        await answer_balance(job.chat_id, new_balance)
+    except Exception as e:
+        logger.error(f"❌ Пакет доставлен, но не записан (резерв {job.reservation_id}): {e}", exc_info=True)
+
+async def generate_and_render(prompt: str, tier: ModelTier, waited=0.0):
+    """Генерация и постобработка: (url, байты оригинала, JPEG-превью).
+
+    Если скачать или обработать не удалось, байтов нет — отправим ссылку.
+    """
+    image_url = await generate_with_replicate(prompt, tier, waited)
+    if not images.enabled:
+        return image_url, None, None
+    
+    try:
+        original = await images.download(image_url)
+        preview, _, _ = await images.preview(original)
+    except Exception as e:
+        logger.warning(f"⚠️ Постобработка не удалась, отправляем ссылку: {e}")
+        return image_url, None, None
+    return image_url, original, preview
+
+async def generate_variants_and_render(prompt: str, count: int, tier: ModelTier, waited=0.0):
+    """N вариантов одним предсказанием: [(url, JPEG-превью или None)]"""
+    image_urls = await generate_variants(prompt, count, tier, waited)
+    if not images.enabled:
+        return [(image_url, None) for image_url in image_urls]
+    
+    try:
+        originals = await asyncio.gather(*(images.download(image_url) for image_url in image_urls))
+        previews = await asyncio.gather(*(images.preview(original) for original in originals))
+    except Exception as e:
+        logger.warning(f"⚠️ Постобработка не удалась, отправляем ссылки: {e}")
+        return [(image_url, None) for image_url in image_urls]
+    return [(image_url, preview) for image_url, (preview, _, _) in zip(image_urls, previews)]
+
+async def send_result(chat_id: int, image_url: str, original, preview, caption: str):
+    """Превью фото из памяти и оригинал документом; без байтов — ссылкой, как раньше"""
+    if preview is None:
+        return await bot.send_photo(chat_id=chat_id, photo=image_url, caption=caption)
+    
+    sent_msg = await bot.send_photo(
+        chat_id=chat_id,
+        photo=BufferedInputFile(preview, filename="preview.jpg"),
+        caption=caption
+    )
+    if IMAGE_SEND_ORIGINAL:
+        # Превью уже доставлено: ошибка с оригиналом не должна повторять всю задачу
+        try:
+            await bot.send_document(
+                chat_id,
+                BufferedInputFile(original, filename=f"image.{DEFAULT_OUTPUT_FORMAT}")
             )
-        elif "rate limit" in error:
-            await message.answer("⏳ Превышен лимит. Подождите 1-2 минуты.")
-        else:
-            await message.answer(f"❌ Ошибка: {str(e)[:100]}")
-        
-        # Возврат кредитов при ошибке
-        await db.add_credits(user_id, COST_STANDARD)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось отправить оригинал: {e}")
+    return sent_msg
+
+async def generation_failed(job: GenerationJob, e: Exception):
+    """Окончательная ошибка генерации: возврат кредитов и сообщение пользователю"""
+    # Сначала возврат: сообщение может не дойти (например, бот заблокирован)
+    await db.release_reservation(job.reservation_id)
+    
+    if isinstance(e, ContentFlaggedError):
+        text = "❌ Контент распознан как неприемлемый.\nИзмените промпт и попробуйте снова."
+    elif isinstance(e, RateLimitError):
+        text = "⏳ Превышен лимит. Подождите 1-2 минуты."
+    elif isinstance(e, PredictionTimeoutError):
+        text = "⏳ Генерация заняла слишком много времени. Попробуйте ещё раз."
+    else:
+        text = f"❌ Ошибка: {str(e)[:100]}"
+    try:
+        await bot.send_message(job.chat_id, text)
+    except Exception as send_error:
+        logger.warning(f"⚠️ Не удалось сообщить об ошибке генерации: {send_error}")
+
+async def run_job_in_memory(job: GenerationJob, submitted: float):
+    """Задача из очереди в памяти: без повторов, ошибка сразу окончательная"""
+    job.waited = time.monotonic() - submitted
+    try:
+        await process_generation(job)
+    except Exception as e:
+        await generation_failed(job, e)
 
-async def generate_with_replicate(prompt: str) -> str:
-    """ЗАГЛУШКА: возвращает тестовое изображение без вызова API"""
-    return "https://picsum.photos/1024/1024?random=15"
+# Очередь генераций в БД: обработчики задач определены выше
+job_queue = JobQueue(
+    db,
+    handler=process_generation,
+    on_failure=generation_failed,
+    workers=GENERATION_WORKERS,
+    queue_size=GENERATION_QUEUE_SIZE,
+    per_user_limit=MAX_JOBS_PER_USER,
+    lease=JOB_LEASE,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    retry_base=JOB_RETRY_BASE,
+    retry_max=JOB_RETRY_MAX,
+    poll_interval=JOB_POLL_INTERVAL,
+    retryable=lambda error: not isinstance(error, ContentFlaggedError)
+)
+
+# ===== РАССЫЛКИ =====
+BROADCAST_STATES = {
+    "running": "идёт",
+    "done": "завершена",
+    "canceled": "остановлена",
+    "lost": "продолжается в другом процессе",
+}
+broadcast_status = {}  # id рассылки -> message_id сообщения о ходе рассылки в чате администратора
+
+def broadcast_progress_text(progress):
+    eta = progress['eta']
+    left = f"{int(eta) // 60}:{int(eta) % 60:02d}" if eta is not None else "—"
+    return (
+        f"📣 <b>Рассылка #{progress['id']}</b>: {BROADCAST_STATES.get(progress['state'], progress['state'])}\n\n"
+        f"✅ Доставлено: {progress['delivered']} из {progress['total']}\n"
+        f"🚫 Заблокировали бота: {progress['blocked']}, ошибок: {progress['failed']}\n"
+        f"⚡ {progress['rate']:.1f} сообщ./с, осталось ~{left}"
+    )
+
+async def report_broadcast(progress):
+    """Первый отчёт — новым сообщением, дальше оно редактируется"""
+    running = progress['state'] == "running"
+    text = broadcast_progress_text(progress)
+    keyboard = get_broadcast_keyboard(progress['id'], running=True) if running else None
+    message_id = broadcast_status.get(progress['id'])
+    if message_id:
+        await bot.edit_message_text(
+            text, chat_id=progress['chat_id'], message_id=message_id, reply_markup=keyboard
+        )
+    else:
+        sent = await bot.send_message(progress['chat_id'], text, reply_markup=keyboard)
+        broadcast_status[progress['id']] = sent.message_id
+    if not running:
+        broadcast_status.pop(progress['id'], None)
+
+broadcaster = Broadcaster(
+    db,
+    bot,
+    rate=BROADCAST_RATE,
+    workers=BROADCAST_WORKERS,
+    segment=BROADCAST_SEGMENT,
+    lease=BROADCAST_LEASE,
+    checkpoint_interval=BROADCAST_CHECKPOINT_INTERVAL,
+    on_progress=report_broadcast
+)
+
+async def record_generation(reservation_id, prompt, image_url=None, file_id=None, cache_key=None,
+                            tier=None):
+    """Закрытие резерва одним запросом; строка generations уходит в пакетную запись"""
+    return await record_generations(reservation_id, prompt, [(image_url, file_id)], cache_key, tier)
+
+async def record_generations(reservation_id, prompt, images, cache_key=None, tier=None):
+    """То же для нескольких изображений: images — [(image_url, file_id)], резерв делится поровну"""
+    settled = await db.settle_reservation(reservation_id)
+    if not settled:
+        return None
+    
+    await history.add_many(
+        settled['user_id'],
+        settled['telegram_id'],
+        prompt,
+        images,
+        cost=settled['amount'] // len(images),
+        cache_key=cache_key,
+        tier=tier
+    )
+    return settled['balance']
+
+async def housekeeping():
+    """Фоновые задачи: возврат незакрытых резервов, чистка обработанных апдейтов, секции истории"""
+    partitions_checked = None
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+        try:
+            refunded = await db.sweep_reservations(RESERVATION_TTL)
+            if refunded:
+                logger.warning(f"⚠️ Возвращены зависшие резервы: {refunded} пользователей")
+            if BOT_MODE == "webhook":
+                await db.sweep_processed_updates(PROCESSED_UPDATES_TTL)
+            if DURABLE_JOBS:
+                await db.sweep_jobs(JOB_RETENTION)
+            if partitions_checked is None or time.monotonic() - partitions_checked > PARTITION_MAINTENANCE_INTERVAL:
+                partitions_checked = time.monotonic()
+                await partitions.run()
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой очистки: {e}")
+
+async def generate_with_replicate(prompt: str, tier: ModelTier, waited=0.0) -> str:
+    """Генерация через Replicate: создание предсказания и ожидание без блокировки event loop"""
+    return (await generate_variants(prompt, 1, tier, waited))[0]
+
+async def generate_variants(prompt: str, count: int, tier: ModelTier, waited=0.0) -> list:
+    """count изображений одним предсказанием (num_outputs).
+
+    waited — сколько задача простояла в очереди: вместе с ожиданием слота
+    уровня это замер, по которому TierRouter переключает на быстрый уровень.
+    """
+    async with tier_router.slot(tier, waited), backend_limiter.slot():
+        with GENERATION_BACKEND_SECONDS.time(tier.name), span("replicate.run"):
+            output = await replicate_client.run(tier.model, {
+                "prompt": prompt,
+                "aspect_ratio": DEFAULT_ASPECT_RATIO,
+                "output_format": DEFAULT_OUTPUT_FORMAT,
+                "num_outputs": count
+            })
+    return output if isinstance(output, list) else [output]
 
 # ===== КОМАНДА /balance =====
 @dp.message(Command("balance"))
@@ -163,6 +608,230 @@ async def cmd_balance(message: Message):
         f"🎨 Создано изображений: {stats['generations_count']}"
     )
 
+# ===== КОМАНДА /history =====
+# Одна запись на страницу; кнопки несут курсор (created_at, id) соседней записи
+def history_cursor(row) -> str:
+    return f"{row['created_at'].isoformat()}_{row['id']}"
+
+def parse_history_cursor(value: str):
+    created_at, _, generation_id = value.rpartition("_")
+    return datetime.fromisoformat(created_at), int(generation_id)
+
+def history_caption(row) -> str:
+    return (
+        f"🕓 {row['created_at']:%d.%m.%Y %H:%M}\n"
+        f"📝 <code>{html.escape(row['prompt'][:200])}</code>"
+    )
+
+@dp.message(Command("history"))
+async def cmd_history(message: Message):
+    rows = await db.get_user_generations(message.from_user.id, limit=2)
+    if not rows:
+        await message.answer("📭 История пуста. Отправьте описание изображения!")
+        return
+    
+    current = rows[0]
+    await message.answer_photo(
+        current['telegram_file_id'],
+        caption=history_caption(current),
+        reply_markup=get_history_keyboard(older=history_cursor(current) if len(rows) > 1 else None)
+    )
+
+@dp.callback_query(F.data.startswith("hist_"))
+async def process_history(callback: CallbackQuery):
+    direction, _, cursor = callback.data.removeprefix("hist_").partition("_")
+    cursor = parse_history_cursor(cursor)
+    user_id = callback.from_user.id
+    
+    # Берём на одну запись больше: по ней видно, есть ли страница дальше
+    if direction == "old":
+        rows = await db.get_user_generations(user_id, limit=2, before=cursor)
+        current = rows[0] if rows else None
+        has_newer, has_older = True, len(rows) > 1
+    else:
+        rows = await db.get_user_generations(user_id, limit=2, after=cursor)
+        current = rows[-1] if rows else None
+        has_newer, has_older = len(rows) > 1, True
+    
+    if not current:
+        await callback.answer("Больше записей нет")
+        return
+    
+    await callback.message.edit_media(
+        InputMediaPhoto(media=current['telegram_file_id'], caption=history_caption(current)),
+        reply_markup=get_history_keyboard(
+            newer=history_cursor(current) if has_newer else None,
+            older=history_cursor(current) if has_older else None
+        )
+    )
+    await callback.answer()
+
+# ===== КОМАНДА /batch — несколько вариантов одного промпта =====
+@dp.message(Command("batch"))
+async def cmd_batch(message: Message, command: CommandObject):
+    prompt = (command.args or "").strip()
+    if len(prompt) < 5:
+        await message.answer("🎲 Напишите промпт после команды:\n<code>/batch кот в космосе</code>")
+        return
+    
+    user = await db.get_user(message.from_user.id)
+    tier = tier_router.get(user['preferred_tier'] if user else None) or tier_router.default
+    
+    # Промпт не влезает в callback_data: кнопки отправляем ответом на сообщение с ним
+    await message.reply(
+        "🎲 Сколько вариантов сгенерировать?",
+        reply_markup=get_batch_keyboard(BATCH_SIZES, tier.cost)
+    )
+
+@dp.callback_query(F.data.startswith("batch_"))
+async def process_batch(callback: CallbackQuery):
+    variants = int(callback.data.replace("batch_", ""))
+    source = callback.message.reply_to_message
+    if variants not in BATCH_SIZES or not source or not source.text:
+        await callback.answer("❌ Отправьте /batch заново")
+        return
+    
+    # Так же, как CommandObject.args в cmd_batch: после команды — любой пробельный символ
+    parts = source.text.split(maxsplit=1)
+    prompt = parts[1].strip() if len(parts) > 1 else ""
+    if len(prompt) < 5:
+        await callback.answer("❌ Промпт слишком короткий. Отправьте /batch заново", show_alert=True)
+        return
+    
+    user_id = callback.from_user.id
+    tier, fell_back = choose_tier(await db.get_user(user_id))
+    
+    # Все N генераций резервируются одним запросом
+    reservation = await db.reserve_credits(user_id, tier.cost * variants)
+    if not reservation:
+        await callback.answer("❌ Недостаточно генераций. Пополните баланс: /buy", show_alert=True)
+        return
+    
+    await callback.message.edit_text(f"🎲 Генерирую {variants} варианта...")
+    await callback.answer()
+    
+    job = GenerationJob(
+        telegram_id=user_id,
+        chat_id=callback.message.chat.id,
+        prompt=prompt,
+        cache_key=make_cache_key(prompt, tier.model, DEFAULT_ASPECT_RATIO, DEFAULT_OUTPUT_FORMAT),
+        reservation_id=reservation['reservation_id'],
+        variants=variants,
+        tier=tier.name
+    )
+    await submit_job(callback.message, job, notice=TIER_FALLBACK_NOTICE if fell_back else None)
+
+# ===== КОМАНДА /model — уровень модели =====
+@dp.message(Command("model"))
+async def cmd_model(message: Message):
+    user = await db.get_user(message.from_user.id)
+    if not user:
+        await message.answer("❌ Напишите /start для регистрации")
+        return
+    
+    current = tier_router.get(user['preferred_tier']) or tier_router.default
+    stats = tier_router.stats()
+    lines = [
+        f"{tier.title} — {tier.cost} генерация, ~{stats[tier.name]['latency_p50']:.0f} с"
+        for tier in tier_router.tiers.values()
+    ]
+    await message.answer(
+        "🧠 <b>Модель для генераций</b>\n\n" + "\n".join(lines) +
+        "\n\nПри большой очереди генерация уходит на быструю модель.",
+        reply_markup=get_tier_keyboard(tier_router.tiers.values(), current.name)
+    )
+
+@dp.callback_query(F.data.startswith("tier_"))
+async def process_tier(callback: CallbackQuery):
+    tier = tier_router.get(callback.data.removeprefix("tier_"))
+    if not tier:
+        await callback.answer("❌ Модель не найдена")
+        return
+    
+    if not await db.set_preferred_tier(callback.from_user.id, tier.name):
+        await callback.answer("❌ Напишите /start для регистрации", show_alert=True)
+        return
+    await callback.message.edit_text(
+        f"✅ Модель: {tier.title}\n💰 {tier.cost} генерация за изображение"
+    )
+    await callback.answer()
+
+# ===== КОМАНДА /cache (для администраторов) =====
+@dp.message(Command("cache"))
+async def cmd_cache(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    stats = result_cache.stats()
+    limiter = backend_limiter.stats()
+    reads = db.router.stats()
+    tiers = "".join(
+        f"\n🧠 {tier_router.tiers[name].title}: в работе {s['in_flight']}, ждут {s['waiting']}, "
+        f"p50 {s['latency_p50']:.1f} с, ожидание ~{s['expected_wait']:.0f} с, "
+        f"выбрано {s['selected']} (переключено на быструю {s['fallbacks']})"
+        for name, s in tier_router.stats().items()
+    )
+    replica = (
+        f"\n🪞 Реплика: отставание {reads['lag']:.1f} с, чтений {reads['replica_reads']} "
+        f"(на основной {reads['primary_reads']})"
+        if db.replica_pool and reads['lag'] is not None else ""
+    )
+    await message.answer(
+        "🗂 <b>Кэш результатов</b>\n\n"
+        f"Записей: {stats['size']}/{stats['max_size']} (TTL {stats['ttl']} с)\n"
+        f"Попадания: {stats['hits']} (память {stats['memory_hits']}, БД {stats['db_hits']})\n"
+        f"Промахи: {stats['misses']}\n"
+        f"Hit rate: {stats['hit_rate']:.1%}\n"
+        f"Вытеснено: {stats['evictions']}, истекло: {stats['expired']}\n"
+        f"Сэкономлено: {stats['bytes_saved'] / 1048576:.1f} МБ, {stats['seconds_saved']} с генерации\n\n"
+        f"⚙️ Лимит генераций: {limiter['limit']} (в работе {limiter['in_flight']}, "
+        f"ждут {limiter['waiting']}, ответов 429: {limiter['overloads']})"
+        f"{tiers}"
+        f"{replica}"
+    )
+
+# ===== КОМАНДА /broadcast (для администраторов) =====
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    # Текст после команды — с форматированием и переносами строк
+    parts = message.html_text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("📣 Текст рассылки — после команды:\n/broadcast Привет! У нас новая модель")
+        return
+
+    text = parts[1]
+    broadcast = await db.create_broadcast(text, message.chat.id)
+    await message.answer(
+        f"📣 <b>Рассылка #{broadcast['id']}</b> — получателей: {broadcast['total']}\n\n{text}",
+        reply_markup=get_broadcast_keyboard(broadcast['id'])
+    )
+
+@dp.callback_query(F.data.startswith("bcast_"))
+async def process_broadcast(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer()
+        return
+
+    action, _, broadcast_id = callback.data.removeprefix("bcast_").partition("_")
+    broadcast_id = int(broadcast_id)
+    if action == "go":
+        if not await db.start_broadcast(broadcast_id):
+            await callback.answer("Рассылка уже запущена или отменена", show_alert=True)
+            return
+        # Рассылку возьмёт первая свободная реплика; в этом процессе — без ожидания опроса
+        broadcaster.wake()
+        await callback.message.edit_reply_markup(
+            reply_markup=get_broadcast_keyboard(broadcast_id, running=True)
+        )
+        await callback.answer("🚀 Рассылка запущена")
+    else:
+        canceled = await db.cancel_broadcast(broadcast_id)
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.answer("⏹ Рассылка остановлена" if canceled else "Рассылка уже завершена")
+
 # ===== КОМАНДА /buy =====
 @dp.message(Command("buy"))
 async def cmd_buy(message: Message):
@@ -215,8 +884,50 @@ async def process_buy(callback: CallbackQuery):
     )
     await callback.answer()
 
+# ===== МЕТРИКИ =====
+def setup_metrics():
+    """Middleware времени обработчиков и Bot API, датчики пула БД и очереди"""
+    dp.update.outer_middleware(UpdateTraceMiddleware(TRACE_SLOW_SECONDS))
+    dp.message.middleware(HandlerTimingMiddleware())
+    dp.callback_query.middleware(HandlerTimingMiddleware())
+    bot.session.middleware(RequestTimingMiddleware())
+    
+    metrics.DB_POOL_SIZE.function = lambda: db.pool.get_size()
+    metrics.DB_POOL_IN_USE.function = lambda: db.pool.get_size() - db.pool.get_idle_size()
+    metrics.DB_POOL_MAX.function = lambda: db.pool.get_max_size()
+    metrics.BACKEND_CONCURRENCY_LIMIT.function = lambda: int(backend_limiter.limit)
+    metrics.BACKEND_WAITING.function = lambda: backend_limiter.waiting
+    metrics.REGISTRY.add_collector(collect_queue_metrics)
+
+async def collect_queue_metrics():
+    if DURABLE_JOBS:
+        # Очередь общая для всех реплик — глубину берём из БД
+        counts = await db.count_jobs()
+        metrics.QUEUE_DEPTH.set(counts['queued'])
+        job_queue.queued = counts['queued']
+        metrics.IN_FLIGHT.set(job_queue.in_flight)
+    else:
+        metrics.QUEUE_DEPTH.set(scheduler.depth)
+        metrics.IN_FLIGHT.set(scheduler.in_flight)
+
 # ===== ЗАПУСК БОТА =====
-async def main():
+# Выставляется, когда процесс может обслуживать апдейты (в режиме webhook — /readyz)
+ready = asyncio.Event()
+
+def mark_ready():
+    ready.set()
+    startup = metrics.process_uptime()
+    metrics.STARTUP_SECONDS.set(startup)
+    logger.info(f"🚀 Готов к работе через {startup:.2f} с после запуска")
+
+async def start_images():
+    """Пул постобработки прогревается в фоне: пока он не готов, результат уходит ссылкой"""
+    try:
+        await images.start()
+    except Exception as e:
+        logger.error(f"❌ Постобработка изображений не запущена: {e}")
+
+async def main(worker_index=0):
     """Основная функция запуска"""
     # Проверка переменных окружения
     required_vars = {
@@ -233,27 +944,112 @@ async def main():
     
     logger.info("✅ Все переменные окружения загружены")
     
+    sweeper = None
+    metrics_server = None
+    image_warmup = None
+    setup_metrics()
+    # Лишние апдейты отсекаем до обработчиков — до запросов к БД и Bot API
+    rate_limit = RateLimitMiddleware(
+        RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST,
+        RATE_LIMIT_GLOBAL_RATE, RATE_LIMIT_GLOBAL_BURST,
+        max_wait=RATE_LIMIT_MAX_WAIT
+    )
+    dp.message.outer_middleware(rate_limit)
+    dp.callback_query.outer_middleware(rate_limit)
     try:
+        # Сервер пула (forkserver) импортирует модули при старте — запускаем его параллельно с остальным
+        if IMAGE_POSTPROCESS:
+            image_warmup = asyncio.create_task(start_images())
+        
         logger.info("Инициализация базы данных...")
         await db.connect()
-        await db.create_tables()
-        logger.info("✅ База данных готова")
+        # При актуальной версии схемы — один SELECT вместо DDL
+        applied, _ = await asyncio.gather(migrate(db), db.start_listener())
+        logger.info(f"✅ База данных готова (применено миграций: {applied})")
         
-        # Установка токена Replicate
-        replicate.default_client.api_token = REPLICATE_API_KEY
+        history.start()
+        # Очередь в памяти нужна, только когда задачи не хранятся в БД
+        if DURABLE_JOBS:
+            job_queue.start()
+        else:
+            scheduler.start()
+        broadcaster.start()
+        sweeper = asyncio.create_task(housekeeping())
         
-        logger.info("🚀 Запуск бота...")
-        await dp.start_polling(bot)
+        await replicate_client.start()
+        
+        if METRICS_PORT:
+            # У каждого процесса вебхука свои счётчики — и свой порт
+            metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT + worker_index)
+        
+        if BOT_MODE == "webhook":
+            from webhook import build_app, serve
+            
+            logger.info(f"🚀 Запуск бота в режиме webhook (процесс #{worker_index})...")
+            # Повтор доставки может прийти в другую реплику — обрабатываем update_id один раз
+            dp.update.outer_middleware(UpdateDedupMiddleware(db))
+            register = WEBHOOK_URL and WEBHOOK_REGISTER and worker_index == 0
+            await serve(
+                build_app(
+                    bot, dp, db, WEBHOOK_PATH, WEBHOOK_SECRET,
+                    replicate_client=replicate_client,
+                    replicate_path=REPLICATE_WEBHOOK_PATH,
+                    ready=ready
+                ),
+                bot,
+                dp,
+                WEBHOOK_HOST,
+                WEBHOOK_PORT,
+                reuse_port=WEBHOOK_WORKERS > 1,
+                webhook_url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH if register else None,
+                secret=WEBHOOK_SECRET,
+                on_ready=mark_ready
+            )
+        else:
+            logger.info("🚀 Запуск бота...")
+            # Оставшийся от режима webhook вебхук мешает getUpdates
+            await bot.delete_webhook()
+            mark_ready()
+            await dp.start_polling(bot)
         
     except KeyboardInterrupt:
         logger.info("🛑 Бот остановлен пользователем")
     except Exception as e:
         logger.error(f"❌ Критическая ошибка: {e}", exc_info=True)
     finally:
+        if DURABLE_JOBS and db.pool:
+            await job_queue.stop()
+        # Идущая рассылка сохраняет прогресс и отпускает аренду — её сразу продолжит другая реплика
+        if db.pool:
+            await broadcaster.stop()
+        if not DURABLE_JOBS:
+            await scheduler.stop()
+        await replicate_client.close()
+        if image_warmup:
+            image_warmup.cancel()
+        await images.stop()
+        if sweeper:
+            sweeper.cancel()
+        if metrics_server:
+            await metrics_server.cleanup()
+        logger.info(f"🗂 Кэш результатов: {result_cache.stats()}")
+        
+        # Сброс отложенной истории до закрытия пула
+        if db.pool:
+            await history.stop()
+            logger.info(f"📝 Запись истории: {history.stats()}")
+        
         if hasattr(db, 'pool') and db.pool:
             await db.close()
         else:
             logger.warning("⚠️ Соединение с БД не было установлено")
 
+def run(worker_index=0):
+    asyncio.run(main(worker_index))
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook" and WEBHOOK_WORKERS > 1:
+        from webhook import run_workers
+        run_workers(run, WEBHOOK_WORKERS)
+    else:
+        run()
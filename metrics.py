@@ -0,0 +1,250 @@
+# metrics.py — метрики в формате Prometheus и трассировка медленных запросов
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_IMPORTED = time.monotonic()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        REGISTRY.register(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    """Значение задаётся set() или вычисляется функцией при каждом сборе"""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self._values = {}
+        self.function = function
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        if self.function:
+            try:
+                return [f"{self.name} {self.function()}"]
+            except Exception as e:
+                logger.warning(f"⚠️ Метрика {self.name} не собрана: {e}")
+                return []
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self._values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [counts по корзинам, сумма, количество]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        lines = []
+        names = self.label_names + ("le",)
+        for labels, (counts, total, count) in self._series.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  # async-функции, обновляющие метрики перед сбором
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    async def render(self):
+        for collector in self.collectors:
+            try:
+                await collector()
+            except Exception as e:
+                logger.warning(f"⚠️ Сборщик метрик завершился ошибкой: {e}")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ===== МЕТРИКИ =====
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработчика aiogram", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Время метода Database (с ожиданием пула)", ["method"])
+DB_POOL_WAIT_SECONDS = Histogram(
+    "bot_db_pool_acquire_seconds", "Ожидание соединения из пула",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+DB_POOL_SIZE = Gauge("bot_db_pool_size", "Открытых соединений в пуле")
+DB_POOL_IN_USE = Gauge("bot_db_pool_in_use", "Занятых соединений пула")
+DB_POOL_MAX = Gauge("bot_db_pool_max_size", "Максимальный размер пула")
+DB_READS = Counter("bot_db_reads_total", "Чтения с маршрутизацией: куда ушли", ["target"])
+DB_REPLICA_LAG = Gauge("bot_db_replica_lag_seconds", "Отставание реплики БД (-1 — недоступна)")
+GENERATION_BACKEND_SECONDS = Histogram(
+    "bot_generation_backend_seconds", "Время генерации в бэкенде (Replicate)", ["tier"],
+    buckets=(0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 120)
+)
+GENERATION_TIER = Counter("bot_generation_tier_total", "Генерации по уровням модели", ["tier"])
+TIER_FALLBACKS = Counter(
+    "bot_generation_tier_fallbacks_total", "Переключения на быстрый уровень из-за ожидания", ["tier"]
+)
+TIER_WAIT_SECONDS = Histogram(
+    "bot_generation_tier_wait_seconds", "Ожидание до старта генерации: очередь и слот уровня", ["tier"]
+)
+HISTORY_FLUSH_SECONDS = Histogram("bot_history_flush_seconds", "Запись пачки истории генераций (COPY)")
+HISTORY_BATCH_SIZE = Histogram(
+    "bot_history_batch_size", "Записей истории в одной пачке",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+)
+HISTORY_DROPPED = Counter("bot_history_dropped_total", "Записи истории, потерянные при переполнении буфера")
+IMAGE_STAGE_SECONDS = Histogram("bot_image_stage_seconds", "Постобработка: загрузка и превью", ["stage"])
+TELEGRAM_REQUEST_SECONDS = Histogram("bot_telegram_request_seconds", "Время запроса к Bot API", ["method"])
+RATE_LIMITED = Counter("bot_rate_limited_total", "Апдейты, отклонённые ограничением частоты", ["scope"])
+BACKEND_CONCURRENCY_LIMIT = Gauge("bot_backend_concurrency_limit", "Текущий адаптивный лимит генераций")
+BACKEND_WAITING = Gauge("bot_backend_waiting", "Генерации, ждущие слота у бэкенда")
+QUEUE_DEPTH = Gauge("bot_generation_queue_depth", "Задач генерации в очереди")
+IN_FLIGHT = Gauge("bot_generation_in_flight", "Генераций в работе в этом процессе")
+BROADCAST_MESSAGES = Counter(
+    "bot_broadcast_messages_total", "Сообщения рассылки: delivered, blocked, failed, retry_after", ["result"]
+)
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "От запуска процесса до готовности принимать апдейты")
+FIRST_UPDATE_SECONDS = Gauge("bot_first_update_seconds", "От запуска процесса до первого обработанного апдейта")
+
+
+def process_uptime():
+    """Секунды с запуска процесса: по /proc в Linux, иначе — с импорта metrics"""
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19])  # starttime, в тиках с загрузки
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED
+
+
+# ===== ТРАССИРОВКА =====
+# Трасса — список (имя, начало, длительность) в пределах одного апдейта или задачи.
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+@contextmanager
+def trace(name, slow_threshold):
+    """Собирает спаны внутри блока и пишет их в лог, если блок дольше slow_threshold"""
+    if not slow_threshold:
+        yield
+        return
+    spans = []
+    token = _trace.set(spans)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+        elapsed = time.perf_counter() - started
+        if elapsed >= slow_threshold:
+            details = ", ".join(f"{n} +{s - started:.3f}s {d * 1000:.0f}ms" for n, s, d in spans)
+            logger.warning(f"🐢 Медленно: {name} {elapsed:.2f} с: {details}")
+
+
+@contextmanager
+def span(name):
+    spans = _trace.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if spans is not None:
+            spans.append((name, started, time.perf_counter() - started))
+
+
+async def metrics_handler(request):
+    from aiohttp import web
+
+    return web.Response(text=await REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host, port):
+    """Отдельный HTTP-сервер для /metrics: не на публичном порту вебхука"""
+    from aiohttp import web  # только при METRICS_PORT
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+    return runner
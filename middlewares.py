@@ -0,0 +1,134 @@
+# middlewares.py — middleware диспетчера aiogram
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import Update
+
+from metrics import (
+    FIRST_UPDATE_SECONDS, HANDLER_ERRORS, HANDLER_SECONDS, RATE_LIMITED, TELEGRAM_REQUEST_SECONDS,
+    process_uptime, span, trace
+)
+from ratelimit import TokenBucket, UserBuckets
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    """Каждый update_id обрабатывается ровно одной репликой.
+
+    Telegram повторяет доставку вебхука при таймауте, а повтор может прийти
+    на другую реплику. Сначала проверяем локальный LRU, затем «захватываем»
+    update_id вставкой в processed_updates — кто вставил, тот и обрабатывает.
+    """
+
+    def __init__(self, db, local_size=10000):
+        self.db = db
+        self.local_size = local_size
+        self._seen = OrderedDict()
+        self.duplicates = 0
+
+    async def __call__(self, handler, event: Update, data):
+        update_id = event.update_id
+        if update_id in self._seen or not await self.db.claim_update(update_id):
+            self.duplicates += 1
+            return None
+
+        self._seen[update_id] = None
+        if len(self._seen) > self.local_size:
+            self._seen.popitem(last=False)
+        return await handler(event, data)
+
+
+class UpdateTraceMiddleware(BaseMiddleware):
+    """Трасса апдейта: спаны БД и Bot API попадают в лог, если апдейт обрабатывался дольше порога.
+
+    Заодно отмечает холодный старт: время от запуска процесса до первого обработанного апдейта.
+    """
+
+    def __init__(self, slow_threshold):
+        self.slow_threshold = slow_threshold
+        self.first_update = None
+
+    async def __call__(self, handler, event: Update, data):
+        try:
+            with trace(f"update {event.update_id}", self.slow_threshold):
+                return await handler(event, data)
+        finally:
+            if self.first_update is None:
+                self.first_update = process_uptime()
+                FIRST_UPDATE_SECONDS.set(self.first_update)
+                logger.info(f"⏱ Первый апдейт обработан через {self.first_update:.2f} с после запуска")
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Гистограмма времени обработчика; метка — имя функции-обработчика.
+
+    Регистрируется как внутренний middleware (dp.message.middleware(...)),
+    чтобы срабатывать только для апдейтов, нашедших обработчик.
+    """
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            with span(f"handler.{name}"):
+                return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class RequestTimingMiddleware(BaseRequestMiddleware):
+    """Время вызовов Bot API по методам (bot.session.middleware(...))"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            with span(f"tg.{name}"):
+                return await make_request(bot, method)
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Ограничение частоты до обработчиков (и до любых запросов к БД).
+
+    Пользователь сверх своей квоты получает отказ — одно предупреждение на
+    серию, остальные апдейты молча отбрасываются. Общая квота процесса
+    ставит апдейт в очередь, если ждать не дольше max_wait, иначе отказ.
+    Регистрируется как внешний middleware на message и callback_query.
+    """
+
+    def __init__(self, user_rate, user_burst, global_rate, global_burst, max_wait=2.0):
+        self.users = UserBuckets(user_rate, user_burst)
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_wait = max_wait
+        self._warned = set()
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user:
+            if not self.users.get(user.id).try_acquire():
+                RATE_LIMITED.inc("user")
+                if user.id not in self._warned:
+                    if len(self._warned) > 100000:
+                        self._warned.clear()
+                    self._warned.add(user.id)
+                    await event.answer("⏳ Слишком много запросов. Подождите несколько секунд.")
+                return None
+            self._warned.discard(user.id)
+
+        if self.global_bucket.delay() > self.max_wait:
+            RATE_LIMITED.inc("global")
+            await event.answer("⏳ Сервис перегружен. Попробуйте через минуту.")
+            return None
+        await self.global_bucket.acquire()
+        return await handler(event, data)
+
@@ -0,0 +1,213 @@
+# migrations.py — версии схемы БД: DDL выполняется, только если схема отстала от кода
+#
+# Миграция — (номер, описание, async-функция от Database). Изменения схемы
+# добавляются в конец MIGRATIONS со следующим номером; применённые миграции не
+# редактируются. DDL внутри пишется идемпотентно (IF NOT EXISTS): если процесс
+# упадёт после DDL, но до записи номера, миграция выполнится повторно.
+import logging
+
+from database import SCHEMA_LOCK
+
+logger = logging.getLogger(__name__)
+
+
+# Схема на момент появления версий. Не редактируется: новые колонки, таблицы и
+# индексы — только следующими миграциями. Всё идемпотентно, поэтому годится и
+# для БД, созданных до версионирования
+BASELINE_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT UNIQUE NOT NULL,
+        username VARCHAR(255),
+        first_name VARCHAR(255),
+        last_name VARCHAR(255),
+        balance INTEGER DEFAULT 0,
+        total_generations INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT NOW(),
+        last_active TIMESTAMP DEFAULT NOW()
+    )
+    ''',
+    # История секционирована по месяцам. Последовательность отдельно от таблицы:
+    # при переводе старой таблицы в секцию (partition_generations.py) новый
+    # родитель продолжает её нумерацию. Таблица, созданная до секционирования,
+    # остаётся обычной до этого перевода — CREATE ... IF NOT EXISTS её не трогает
+    'CREATE SEQUENCE IF NOT EXISTS generations_id_seq',
+    '''
+    CREATE TABLE IF NOT EXISTS generations (
+        id INTEGER NOT NULL DEFAULT nextval('generations_id_seq'),
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        telegram_id BIGINT NOT NULL,
+        prompt TEXT NOT NULL,
+        negative_prompt TEXT,
+        image_url TEXT,
+        telegram_file_id VARCHAR(255),
+        cost INTEGER DEFAULT 1,
+        cache_key VARCHAR(64),
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    ''',
+    'ALTER SEQUENCE generations_id_seq OWNED BY generations.id',
+    'ALTER TABLE generations ADD COLUMN IF NOT EXISTS cache_key VARCHAR(64)',
+    '''
+    CREATE TABLE IF NOT EXISTS purchases (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        telegram_id BIGINT NOT NULL,
+        package VARCHAR(50) NOT NULL,
+        amount_rub INTEGER NOT NULL,
+        credits_added INTEGER NOT NULL,
+        payment_id VARCHAR(255) UNIQUE,
+        status VARCHAR(20) DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT NOW(),
+        paid_at TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS credit_reservations (
+        id BIGSERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        telegram_id BIGINT NOT NULL,
+        amount INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT NOW()
+    )
+    ''',
+    # Обработанные апдейты: защита от повторной обработки в нескольких репликах
+    '''
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id BIGINT PRIMARY KEY,
+        received_at TIMESTAMP DEFAULT NOW()
+    )
+    ''',
+    # Очередь генераций: queued → running → done/failed
+    '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id BIGSERIAL PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        chat_id BIGINT NOT NULL,
+        prompt TEXT NOT NULL,
+        cache_key VARCHAR(64),
+        reservation_id BIGINT,
+        variants INTEGER NOT NULL DEFAULT 1,
+        state VARCHAR(10) NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        run_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        lease_until TIMESTAMP,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT NOW(),
+        finished_at TIMESTAMP
+    )
+    ''',
+    'ALTER TABLE jobs ADD COLUMN IF NOT EXISTS variants INTEGER NOT NULL DEFAULT 1',
+    'CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)',
+    # История пользователя: keyset-пагинация по (created_at, id); индекс по одному
+    # telegram_id он заменяет полностью
+    'CREATE INDEX IF NOT EXISTS idx_generations_user_history ON generations(telegram_id, created_at DESC, id DESC)',
+    'DROP INDEX IF EXISTS idx_generations_telegram_id',
+    'CREATE INDEX IF NOT EXISTS idx_generations_cache_key ON generations(cache_key, created_at DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_credit_reservations_created_at ON credit_reservations(created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_processed_updates_received_at ON processed_updates(received_at)',
+    "CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs(run_at) WHERE state = 'queued'",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs(lease_until) WHERE state = 'running'",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_active_user ON jobs(telegram_id) WHERE state IN ('queued', 'running')",
+    'CREATE INDEX IF NOT EXISTS idx_jobs_reservation_id ON jobs(reservation_id)',
+    "CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs(finished_at) WHERE state IN ('done', 'failed')",
+    # Изменения users из любых процессов рассылаются через NOTIFY (канал
+    # USER_CHANGED_CHANNEL), чтобы кэши пользователей в других репликах сбрасывали записи
+    '''
+    CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify(
+            'user_changed',
+            current_setting('application_name') || ':' || OLD.telegram_id
+        );
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS users_notify_changed ON users',
+    '''
+    CREATE TRIGGER users_notify_changed
+    AFTER UPDATE OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION notify_user_changed()
+    ''',
+]
+
+
+async def _baseline(db):
+    async with db.acquire() as conn:
+        for statement in BASELINE_SQL:
+            await conn.execute(statement)
+    await db.ensure_generation_partitions()
+
+
+async def _model_tiers(db):
+    # На секционированной generations колонка добавляется во все секции
+    async with db.acquire() as conn:
+        await conn.execute('ALTER TABLE generations ADD COLUMN IF NOT EXISTS tier VARCHAR(16)')
+        await conn.execute('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS tier VARCHAR(16)')
+        await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS preferred_tier VARCHAR(16)')
+
+
+async def _broadcasts(db):
+    async with db.acquire() as conn:
+        # Рассылки: draft → running → done/canceled; last_user_id — контрольная точка
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id BIGSERIAL PRIMARY KEY,
+                text TEXT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                state VARCHAR(10) NOT NULL DEFAULT 'draft',
+                total INTEGER NOT NULL DEFAULT 0,
+                delivered INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                last_user_id INTEGER NOT NULL DEFAULT 0,
+                owner VARCHAR(64),
+                lease_until TIMESTAMP,
+                created_at TIMESTAMP DEFAULT NOW(),
+                updated_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(id) WHERE state = 'running'"
+        )
+        # Заблокировавшие бота не получают рассылки, пока снова не напишут /start
+        await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP')
+
+
+MIGRATIONS = [
+    (1, "базовая схема", _baseline),
+    (2, "уровни моделей: generations.tier, jobs.tier, users.preferred_tier", _model_tiers),
+    (3, "рассылки: broadcasts, users.blocked_at", _broadcasts),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def migrate(db):
+    """Довести схему до SCHEMA_VERSION; возвращает число применённых миграций.
+
+    Если схема актуальна — один SELECT, без DDL и блокировок каталога.
+    Реплики, стартующие одновременно, ждут друг друга на SCHEMA_LOCK
+    (блокировка держит одно соединение пула, миграции берут другое).
+    """
+    version = await db.schema_version()
+    if version > SCHEMA_VERSION:
+        logger.warning(f"⚠️ Схема БД новее кода: {version} > {SCHEMA_VERSION}")
+    if version >= SCHEMA_VERSION:
+        return 0
+
+    applied = 0
+    async with db.advisory_lock(SCHEMA_LOCK, wait=True):
+        version = await db.schema_version()  # могла применить реплика, державшая блокировку
+        for number, description, apply in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info(f"🛠 Миграция {number}: {description}")
+            await apply(db)
+            await db.record_migration(number, description)
+            applied += 1
+    return applied
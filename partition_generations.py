@@ -0,0 +1,176 @@
+# partition_generations.py — перевод существующей таблицы generations в секционированную
+#
+#   DATABASE_URL=... python partition_generations.py --dry-run
+#   DATABASE_URL=... python partition_generations.py
+#
+# Данные не копируются: старая таблица становится секцией generations_legacy
+# с диапазоном от MINVALUE до первого числа месяца после следующего; строки
+# с этой даты идут в месячные секции. Когда граница legacy выйдет
+# за срок хранения, PartitionMaintenance выгрузит её в архив целиком.
+#
+# 1–3 выполняются без блокировки записи (CHECK NOT VALID + VALIDATE, индекс
+# CONCURRENTLY) и могут занять время на большой таблице; 4 — короткая транзакция
+# под ACCESS EXCLUSIVE, без сканирования данных; 5 — индексы родителя.
+#
+# Запускать после обновления бота: сначала применяются миграции схемы, и колонки
+# старой таблицы должны совпасть с родителем. Если шаги 1–4 не прошли, CHECK
+# снимается (иначе после cutoff он отклонит новые строки) и запуск можно повторить.
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+
+from database import Database
+from migrations import migrate as migrate_schema
+from partitions import month_start
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Родитель с колонками текущей схемы (migrations.py): у секции и родителя они должны совпадать
+PARENT_TABLE_SQL = '''
+    CREATE TABLE generations (
+        id INTEGER NOT NULL DEFAULT nextval('generations_id_seq'),
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        telegram_id BIGINT NOT NULL,
+        prompt TEXT NOT NULL,
+        negative_prompt TEXT,
+        image_url TEXT,
+        telegram_file_id VARCHAR(255),
+        cost INTEGER DEFAULT 1,
+        cache_key VARCHAR(64),
+        created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        tier VARCHAR(16),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+'''
+PARENT_COLUMNS = {
+    'id', 'user_id', 'telegram_id', 'prompt', 'negative_prompt', 'image_url',
+    'telegram_file_id', 'cost', 'cache_key', 'created_at', 'tier',
+}
+DROP_BOUND_SQL = "ALTER TABLE generations DROP CONSTRAINT IF EXISTS generations_legacy_bound"
+
+
+def plan(cutoff):
+    bound = f"'{cutoff:%Y-%m-%d}'"
+    online = [
+        # Остатки прерванного запуска: граница выводится заново, недостроенный индекс — пересобирается
+        DROP_BOUND_SQL,
+        "DROP INDEX CONCURRENTLY IF EXISTS generations_legacy_id_created_at",
+        # 1. Все строки старше cutoff; NOT VALID — без сканирования под блокировкой
+        f"ALTER TABLE generations ADD CONSTRAINT generations_legacy_bound "
+        f"CHECK (created_at IS NOT NULL AND created_at < {bound}) NOT VALID",
+        # 2. Проверка существующих строк, запись не блокируется
+        "ALTER TABLE generations VALIDATE CONSTRAINT generations_legacy_bound",
+        # 3. Уникальный индекс под первичный ключ родителя (id, created_at)
+        "CREATE UNIQUE INDEX CONCURRENTLY generations_legacy_id_created_at "
+        "ON generations (id, created_at)",
+    ]
+    swap = [
+        # 4. Переименование и подключение старой таблицы секцией
+        "SET LOCAL lock_timeout = '5s'",
+        "LOCK TABLE generations IN ACCESS EXCLUSIVE MODE",
+        "ALTER TABLE generations RENAME TO generations_legacy",
+        # Валидный CHECK избавляет SET NOT NULL и ATTACH от сканирования таблицы
+        "ALTER TABLE generations_legacy ALTER COLUMN created_at SET NOT NULL",
+        # Ключ (id, created_at) на готовом индексе из шага 3 — ATTACH подключит его к ключу родителя
+        "ALTER TABLE generations_legacy DROP CONSTRAINT generations_pkey",
+        "ALTER TABLE generations_legacy ADD CONSTRAINT generations_legacy_pkey "
+        "PRIMARY KEY USING INDEX generations_legacy_id_created_at",
+        # Имена индексов занимает родитель; при CREATE INDEX на родителе эти индексы подключатся
+        "ALTER INDEX IF EXISTS idx_generations_user_history RENAME TO generations_legacy_user_history",
+        "ALTER INDEX IF EXISTS idx_generations_cache_key RENAME TO generations_legacy_cache_key",
+        "ALTER INDEX IF EXISTS idx_generations_telegram_id RENAME TO generations_legacy_telegram_id",
+        PARENT_TABLE_SQL.strip(),
+        "ALTER SEQUENCE generations_id_seq OWNED BY generations.id",
+        f"ALTER TABLE generations ATTACH PARTITION generations_legacy FOR VALUES FROM (MINVALUE) TO ({bound})",
+        "ALTER TABLE generations_legacy DROP CONSTRAINT generations_legacy_bound",
+    ]
+    finish = [
+        # 5. Индексы родителя: подключают переименованные индексы legacy, без сборки
+        "CREATE INDEX IF NOT EXISTS idx_generations_user_history "
+        "ON generations(telegram_id, created_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_cache_key ON generations(cache_key, created_at DESC)",
+    ]
+    return online, swap, finish
+
+
+async def migrate(dry_run=False):
+    # Граница с запасом в месяц: строки с NOW() до неё проходят CHECK, пока идёт миграция
+    cutoff = month_start(datetime.now(), 2)
+    online, swap, finish = plan(cutoff)
+
+    if dry_run:
+        print(";\n".join(online + ["BEGIN"] + swap + ["COMMIT"] + finish) + ";")
+        return
+
+    db = Database(user_cache_size=0)
+    await db.connect()
+    try:
+        # Колонки более поздних миграций (cache_key, tier) должны быть и в старой таблице
+        await migrate_schema(db)
+        async with db.pool.acquire() as conn:
+            partitioned = await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'generations'::regclass)"
+            )
+            if partitioned:
+                logger.info("✅ generations уже секционирована")
+                return
+
+            columns = {
+                row['column_name'] for row in await conn.fetch(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_schema = current_schema() AND table_name = 'generations'"
+                )
+            }
+            if columns != PARENT_COLUMNS:
+                logger.error(
+                    f"❌ Колонки generations не совпадают с родителем: нет {sorted(PARENT_COLUMNS - columns)}, "
+                    f"лишние {sorted(columns - PARENT_COLUMNS)}. Обновите бота и partition_generations.py"
+                )
+                return
+
+            try:
+                for statement in online:
+                    logger.info(statement)
+                    await conn.execute(statement)
+
+                async with conn.transaction():
+                    for statement in swap:
+                        logger.info(statement)
+                        await conn.execute(statement)
+            except BaseException:
+                await _drop_bound(conn)
+                raise
+
+            for statement in finish:
+                logger.info(statement)
+                await conn.execute(statement)
+
+        # Месячные секции после cutoff
+        await db.ensure_generation_partitions()
+        logger.info(f"✅ generations секционирована; generations_legacy — до {cutoff:%Y-%m-%d}")
+    finally:
+        await db.close()
+
+
+async def _drop_bound(conn):
+    """Снять CHECK с живой таблицы после сбоя; ждать блокировку не дольше 5 с"""
+    try:
+        async with conn.transaction():
+            await conn.execute("SET LOCAL lock_timeout = '5s'")
+            await conn.execute(DROP_BOUND_SQL)
+        logger.warning("⚠️ Перевод не завершён, generations_legacy_bound снят — запуск можно повторить")
+    except Exception as e:
+        logger.error(f"❌ generations_legacy_bound не снят ({e}); выполните вручную: {DROP_BOUND_SQL}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перевод generations в секционированную таблицу")
+    parser.add_argument("--dry-run", action="store_true", help="только вывести SQL")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
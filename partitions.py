@@ -0,0 +1,100 @@
+# partitions.py — месячные секции generations: создание наперёд, выгрузка и удаление старых
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME = re.compile(r"^generations_(y\d{4}m\d{2}|legacy)$")
+ARCHIVE_LOCK = 160002  # pg_advisory_lock: выгрузку выполняет одна реплика
+
+
+def month_start(moment, offset=0):
+    """Первое число месяца moment, сдвинутого на offset месяцев"""
+    month = moment.year * 12 + moment.month - 1 + offset
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(start):
+    return f"generations_y{start:%Y}m{start:%m}"
+
+
+class PartitionMaintenance:
+    """Обслуживание секций generations (запускается из housekeeping).
+
+    Создаёт секции на months_ahead месяцев вперёд. Секции, целиком старше
+    retention_months, отсоединяет, выгружает в archive_dir как CSV.gz и
+    удаляет. Если процесс упал между шагами, отсоединённая таблица
+    останется и будет выгружена при следующем запуске.
+    """
+
+    def __init__(self, db, retention_months=12, archive_dir="archive", months_ahead=2):
+        self.db = db
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.months_ahead = months_ahead
+
+        self.archived = 0
+        self.archived_rows = 0
+
+    async def run(self):
+        created = await self.db.ensure_generation_partitions(self.months_ahead)
+        if created is None:
+            logger.warning("⚠️ generations не секционирована — см. partition_generations.py")
+            return
+        if created:
+            logger.info(f"🗓 Созданы секции: {', '.join(created)}")
+        if self.retention_months:
+            await self.archive_expired()
+
+    async def archive_expired(self):
+        """Выгрузить и удалить секции, вышедшие за срок хранения. Возвращает пути архивов"""
+        cutoff = month_start(datetime.now(), -self.retention_months)
+        archived = []
+        async with self.db.advisory_lock(ARCHIVE_LOCK) as locked:
+            if not locked:
+                return archived
+            for partition in await self.db.generation_partitions():
+                if partition['attached']:
+                    if not partition['upper'] or partition['upper'] > cutoff:
+                        continue
+                    await self.db.detach_generation_partition(partition['name'])
+                archived.append(await self.archive(partition['name']))
+        return archived
+
+    async def archive(self, name):
+        """Отсоединённую таблицу — в archive_dir/<name>.csv.gz, затем DROP"""
+        if not PARTITION_NAME.match(name):
+            raise ValueError(f"not a generations partition: {name}")
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{name}.csv.gz")
+        partial_path = path + ".part"
+
+        # Сжатие в потоке, чтобы не держать event loop
+        archive = await asyncio.to_thread(gzip.open, partial_path, "wb")
+        try:
+            async def write(chunk):
+                await asyncio.to_thread(archive.write, chunk)
+
+            rows = await self.db.export_table(name, write)
+        finally:
+            await asyncio.to_thread(archive.close)
+
+        # Файл на диске до удаления таблицы: при сбое данные есть хотя бы в одном месте
+        await asyncio.to_thread(_fsync, partial_path)
+        os.replace(partial_path, path)
+        await self.db.drop_table(name)
+
+        self.archived += 1
+        self.archived_rows += rows
+        logger.info(f"📦 Секция {name} выгружена в {path} ({rows} строк) и удалена")
+        return path
+
+
+def _fsync(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
@@ -0,0 +1,149 @@
+# ratelimit.py — ограничение нагрузки: token bucket для входящих апдейтов, AIMD для бэкенда генерации
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """Через сколько секунд будет tokens токенов"""
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def reserve(self, tokens=1):
+        """Забрать токены в долг; возвращает, сколько ждать до их появления.
+
+        Долг выстраивает ожидающих в очередь: каждый следующий ждёт дольше.
+        """
+        self._refill()
+        self.tokens -= tokens
+        return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Адаптивный лимит одновременных вызовов (AIMD).
+
+    Успешный вызов при заполненном лимите поднимает его на 1/limit, то есть
+    примерно на единицу за «окно» вызовов. Ошибка перегрузки (429) умножает
+    лимит на decrease — один раз на волну: ошибки вызовов, начатых до
+    предыдущего снижения, лимит больше не трогают. retry_after из ошибки
+    приостанавливает новые вызовы.
+    """
+
+    def __init__(self, initial=8, min_limit=1, max_limit=64, decrease=0.5, overload_errors=()):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.overload_errors = overload_errors
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+
+        self.decreases = 0
+        self.overloads = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        started = time.monotonic()
+        overloaded = succeeded = False
+        retry_after = None
+        try:
+            yield
+            succeeded = True
+        except self.overload_errors as e:
+            overloaded = True
+            retry_after = getattr(e, "retry_after", None)
+            raise
+        finally:
+            await self._release(started, succeeded, overloaded, retry_after)
+
+    async def _acquire(self):
+        self.waiting += 1
+        try:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            async with self._cond:
+                await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+                self.in_flight += 1
+        finally:
+            self.waiting -= 1
+
+    async def _release(self, started, succeeded, overloaded, retry_after):
+        async with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if overloaded:
+                self.overloads += 1
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._last_decrease = time.monotonic()
+                    self.decreases += 1
+                    logger.warning(f"⚠️ Перегрузка бэкенда: лимит одновременных генераций {int(self.limit)}")
+                if retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            elif succeeded and saturated:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "overloads": self.overloads,
+            "decreases": self.decreases,
+        }
+
+
+class UserBuckets:
+    """telegram_id -> TokenBucket; давно молчавших пользователей вытесняем (их ведро всё равно полное)"""
+
+    def __init__(self, rate, capacity, max_size=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def get(self, telegram_id):
+        bucket = self._buckets.get(telegram_id)
+        if bucket is None:
+            bucket = self._buckets[telegram_id] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(telegram_id)
+        return bucket
@@ -0,0 +1,57 @@
+# replay_updates.py — отправка записанных апдейтов на локальный вебхук
+#
+#   BOT_MODE=webhook python main.py
+#   python replay_updates.py updates.jsonl --url http://localhost:8080/webhook --duplicates 2
+#
+# Файл — JSON-массив апдейтов или по одному апдейту на строку (формат getUpdates).
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from config import WEBHOOK_SECRET
+
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+async def replay(updates, url, secret=None, duplicates=1, concurrency=10):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(url, json=update) as response:
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        # Повторы одного update_id имитируют повторную доставку Telegram
+        started = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates for _ in range(duplicates)))
+        elapsed = time.perf_counter() - started
+
+    print(f"Отправлено: {len(updates) * duplicates} за {elapsed:.2f} с, статусы: {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправка записанных апдейтов на вебхук")
+    parser.add_argument("file")
+    parser.add_argument("--url", default="http://localhost:8080/webhook")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    parser.add_argument("--duplicates", type=int, default=1, help="сколько раз слать каждый апдейт")
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    asyncio.run(replay(load_updates(args.file), args.url, args.secret, args.duplicates, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
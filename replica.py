@@ -0,0 +1,69 @@
+# replica.py — маршрутизация чтений между основным сервером и репликой
+import time
+from collections import OrderedDict
+
+# Отставание реплики: 0, если всё полученное WAL применено (или это не standby)
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END::float8
+'''
+
+
+class ReadRouter:
+    """Решает, можно ли прочитать с реплики.
+
+    Правила:
+    - отставание реплики известно и не больше max_lag (lag=None — реплика
+      недоступна или ещё не проверена);
+    - пользователь не менял свои данные последние read_your_writes секунд и
+      дольше текущего отставания: баланс сразу после списания читается с
+      основного сервера. Изменением считаются и записи других процессов,
+      пришедшие через NOTIFY.
+    """
+
+    def __init__(self, max_lag=5.0, read_your_writes=5.0, check_interval=1.0, max_size=100000):
+        self.max_lag = max_lag
+        self.read_your_writes = read_your_writes
+        self.check_interval = check_interval
+        self.max_size = max_size
+        self.lag = None
+        self._writes = OrderedDict()  # telegram_id -> time.monotonic() последней записи
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def wrote(self, telegram_id):
+        self._writes[telegram_id] = time.monotonic()
+        self._writes.move_to_end(telegram_id)
+        # Старые записи вытесняются первыми; окно короткое, поэтому хватает LRU
+        while len(self._writes) > self.max_size:
+            self._writes.popitem(last=False)
+
+    def written_at(self, telegram_id):
+        return self._writes.get(telegram_id)
+
+    def use_replica(self, telegram_id=None):
+        lag = self.lag
+        if lag is None or lag > self.max_lag:
+            self.primary_reads += 1
+            return False
+        if telegram_id is not None:
+            wrote_at = self._writes.get(telegram_id)
+            # Отставание измерено до check_interval назад — учитываем и его
+            window = max(self.read_your_writes, lag + self.check_interval)
+            if wrote_at is not None and time.monotonic() - wrote_at < window:
+                self.primary_reads += 1
+                return False
+        self.replica_reads += 1
+        return True
+
+    def stats(self):
+        return {
+            "lag": self.lag,
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "tracked_users": len(self._writes),
+        }
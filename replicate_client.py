@@ -0,0 +1,241 @@
+# replicate_client.py — асинхронный клиент Replicate: создание предсказаний и ожидание результата
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+
+def parse_retry_after(value):
+    """Retry-After в секундах: число или HTTP-дата; None, если заголовка нет или он непонятен"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class ReplicateError(Exception):
+    """Ошибка API Replicate.
+
+    http_status — код ответа API, prediction_status — статус завершившегося
+    предсказания (failed, canceled); задан только один из них.
+    """
+
+    def __init__(self, message, prediction_id=None, http_status=None, prediction_status=None):
+        super().__init__(message)
+        self.prediction_id = prediction_id
+        self.http_status = http_status
+        self.prediction_status = prediction_status
+
+
+class RateLimitError(ReplicateError):
+    """429: слишком много запросов"""
+
+    def __init__(self, message, retry_after=None, **kwargs):
+        super().__init__(message, **kwargs)
+        self.retry_after = retry_after
+
+
+class ContentFlaggedError(ReplicateError):
+    """Модель отклонила промпт или результат (NSFW)"""
+
+
+class PredictionFailedError(ReplicateError):
+    """Предсказание завершилось со статусом failed"""
+
+
+class PredictionCanceledError(ReplicateError):
+    """Предсказание отменено"""
+
+
+class PredictionTimeoutError(ReplicateError):
+    """Результат не получен за отведённое время"""
+
+
+class ReplicateClient:
+    """Клиент поверх одной aiohttp-сессии с пулом keep-alive соединений.
+
+    run() создаёт предсказание и ждёт результат, опрашивая его с растущим
+    интервалом. Первый опрос — ближе к типичному времени генерации, которое
+    клиент запоминает сам. Если задан webhook_url, Replicate сообщает о
+    завершении, и notify() будит ожидающего сразу; опрос остаётся подстраховкой
+    (колбэк может прийти в другой процесс).
+    """
+
+    def __init__(self, api_token, base_url="https://api.replicate.com/v1", timeout=180,
+                 poll_min=0.5, poll_max=3.0, pool_size=100, webhook_url=None):
+        self.api_token = api_token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.pool_size = pool_size
+        self.webhook_url = webhook_url
+        self.session = None
+        self._waiters = {}  # prediction id -> Event
+        self._avg_latency = 0.0
+
+        self.predictions = 0
+        self.polls = 0
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+            headers={"Authorization": f"Bearer {self.api_token}"},
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def run(self, model, input):
+        """Создать предсказание и дождаться результата. Возвращает output"""
+        started = time.monotonic()
+        prediction = await self.create_prediction(model, input)
+        prediction_id = prediction["id"]
+        try:
+            result = await asyncio.wait_for(self.wait(prediction), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            await self._cancel_quietly(prediction_id)
+            raise PredictionTimeoutError(
+                f"prediction {prediction_id} timed out after {self.timeout}s",
+                prediction_id=prediction_id
+            )
+        except asyncio.CancelledError:
+            # Отменённую у нас генерацию отменяем и на стороне Replicate
+            asyncio.ensure_future(self._cancel_quietly(prediction_id))
+            raise
+        except ReplicateError as e:
+            # Завершившееся предсказание отменять незачем; иначе оно доработает и будет оплачено,
+            # а повтор задачи создаст второе
+            if e.prediction_status not in TERMINAL_STATUSES:
+                await self._cancel_quietly(prediction_id)
+            raise
+        except BaseException:
+            await self._cancel_quietly(prediction_id)
+            raise
+
+        elapsed = time.monotonic() - started
+        self._avg_latency = elapsed if not self._avg_latency else self._avg_latency * 0.9 + elapsed * 0.1
+        return result["output"]
+
+    async def create_prediction(self, model, input):
+        payload = {"input": input}
+        if self.webhook_url:
+            payload["webhook"] = self.webhook_url
+            payload["webhook_events_filter"] = ["completed"]
+        self.predictions += 1
+        return await self._request("POST", f"/models/{model}/predictions", json=payload)
+
+    async def get_prediction(self, prediction_id):
+        return await self._request("GET", f"/predictions/{prediction_id}")
+
+    async def cancel_prediction(self, prediction_id):
+        return await self._request("POST", f"/predictions/{prediction_id}/cancel")
+
+    async def wait(self, prediction):
+        prediction_id = prediction["id"]
+        event = self._waiters[prediction_id] = asyncio.Event()
+        try:
+            delay = max(self.poll_min, self._avg_latency * 0.7)
+            while prediction["status"] not in TERMINAL_STATUSES:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+                self.polls += 1
+                try:
+                    prediction = await self.get_prediction(prediction_id)
+                except RateLimitError as e:
+                    # Предсказание идёт и без нас: переждать лимит и спросить снова
+                    delay = (
+                        max(e.retry_after, self.poll_min) if e.retry_after is not None
+                        else min(delay * 2, self.poll_max)
+                    )
+                    logger.warning(f"⚠️ Опрос {prediction_id}: 429, повтор через {delay:.1f} с")
+                    continue
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    delay = min(delay * 2, self.poll_max)
+                    logger.warning(f"⚠️ Опрос {prediction_id}: {e!r}, повтор через {delay:.1f} с")
+                    continue
+                except ReplicateError as e:
+                    if not e.http_status or e.http_status < 500:
+                        raise
+                    delay = min(delay * 2, self.poll_max)
+                    logger.warning(f"⚠️ Опрос {prediction_id}: HTTP {e.http_status}, повтор через {delay:.1f} с")
+                    continue
+                delay = min(max(delay * 1.5, self.poll_min), self.poll_max)
+        finally:
+            self._waiters.pop(prediction_id, None)
+        return self._check(prediction)
+
+    def notify(self, prediction_id):
+        """Колбэк вебхука Replicate: ожидающий сразу перечитывает предсказание"""
+        event = self._waiters.get(prediction_id)
+        if event:
+            event.set()
+        return event is not None
+
+    def stats(self):
+        return {
+            "predictions": self.predictions,
+            "polls": self.polls,
+            "waiting": len(self._waiters),
+            "avg_latency": round(self._avg_latency, 2),
+        }
+
+    def _check(self, prediction):
+        prediction_id = prediction.get("id")
+        status = prediction["status"]
+        if status == "succeeded":
+            return prediction
+
+        error = str(prediction.get("error") or status)
+        lowered = error.lower()
+        if status == "canceled":
+            raise PredictionCanceledError(error, prediction_id=prediction_id, prediction_status=status)
+        if "nsfw" in lowered or "inappropriate" in lowered or "safety" in lowered:
+            raise ContentFlaggedError(error, prediction_id=prediction_id, prediction_status=status)
+        raise PredictionFailedError(error, prediction_id=prediction_id, prediction_status=status)
+
+    async def _request(self, method, path, json=None):
+        async with self.session.request(method, self.base_url + path, json=json) as response:
+            if response.status == 429:
+                raise RateLimitError(
+                    "rate limit exceeded",
+                    retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                    http_status=429
+                )
+            if response.status >= 400:
+                try:
+                    body = await response.json(content_type=None)
+                    detail = body.get("detail") if isinstance(body, dict) else body
+                except ValueError:
+                    detail = (await response.text())[:200]
+                error_class = ContentFlaggedError if "nsfw" in str(detail).lower() else ReplicateError
+                raise error_class(f"HTTP {response.status}: {detail}", http_status=response.status)
+            return await response.json(content_type=None)
+
+    async def _cancel_quietly(self, prediction_id):
+        try:
+            await self.cancel_prediction(prediction_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось отменить предсказание {prediction_id}: {e}")
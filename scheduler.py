@@ -0,0 +1,86 @@
+# scheduler.py — планировщик генераций: фиксированный пул воркеров и ограниченная очередь
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Очередь генераций заполнена"""
+
+
+class UserLimitError(Exception):
+    """У пользователя слишком много генераций в работе"""
+
+
+class GenerationScheduler:
+    def __init__(self, workers=8, queue_size=200, per_user_limit=2):
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.in_flight = 0
+        self._user_jobs = {}  # telegram_id -> задач в очереди и в работе
+        self._tasks = []
+
+    def start(self):
+        """Запуск воркеров"""
+        for n in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(n), name=f"generation-worker-{n}"))
+        logger.info(f"✅ Планировщик запущен: {self.workers} воркеров, очередь {self.queue.maxsize}")
+
+    async def stop(self, drain_timeout=30):
+        """Остановка: дожидаемся текущих задач, затем гасим воркеров"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Очередь не разобрана за {drain_timeout} с, осталось {self.queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def submit(self, user_id, job):
+        """Постановка задачи в очередь.
+
+        job — корутинная функция без аргументов. Возвращает позицию в очереди
+        (0 — задача начнёт выполняться сразу).
+        """
+        if self._user_jobs.get(user_id, 0) >= self.per_user_limit:
+            raise UserLimitError(user_id)
+
+        try:
+            self.queue.put_nowait((user_id, job))
+        except asyncio.QueueFull:
+            raise QueueFullError(self.queue.maxsize)
+
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+
+        idle = self.workers - self.in_flight
+        waiting = self.queue.qsize()
+        return max(waiting - idle, 0)
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def _release_user(self, user_id):
+        left = self._user_jobs.get(user_id, 0) - 1
+        if left > 0:
+            self._user_jobs[user_id] = left
+        else:
+            self._user_jobs.pop(user_id, None)
+
+    async def _worker(self, n):
+        while True:
+            user_id, job = await self.queue.get()
+            self.in_flight += 1
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка задачи генерации (воркер {n}): {e}", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                self._release_user(user_id)
+                self.queue.task_done()
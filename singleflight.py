@@ -0,0 +1,44 @@
+# singleflight.py — объединение одинаковых одновременных вызовов в один
+import asyncio
+from functools import partial
+
+
+class SingleFlight:
+    """Одновременные вызовы с одним ключом ждут общий результат.
+
+    Первый вызов запускает задачу, остальные ждут её же. Исключение
+    получают все ожидающие, отмена одного ожидающего общую задачу не отменяет.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(partial(self._done, key))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        self._calls.pop(key, None)
+        # Ошибку уже получили ожидающие; забираем её, если все они были отменены
+        if not task.cancelled():
+            task.exception()
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
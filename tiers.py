@@ -0,0 +1,127 @@
+# tiers.py — уровни моделей (быстрый, качественный) и выбор уровня по нагрузке
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from metrics import GENERATION_TIER, TIER_FALLBACKS, TIER_WAIT_SECONDS
+
+
+@dataclass(frozen=True)
+class ModelTier:
+    name: str          # ключ в БД (generations.tier, users.preferred_tier) и в callback_data
+    title: str
+    model: str         # модель Replicate
+    cost: int          # кредитов за изображение
+    latency: float     # ожидаемая длительность генерации, с — пока нет своих замеров
+    concurrency: int   # одновременных генераций этого уровня в процессе
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class _TierState:
+    def __init__(self, tier, window):
+        self.semaphore = asyncio.Semaphore(tier.concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.waits = deque(maxlen=window)      # (time.monotonic(), ожидание до старта генерации, с)
+        self.latencies = deque(maxlen=window)  # длительность генерации, с
+        self.selected = 0
+        self.fallbacks = 0
+
+
+class TierRouter:
+    """Выбор уровня модели для новой генерации.
+
+    Берётся уровень, выбранный пользователем (или default). Если ожидаемое
+    ожидание на нём больше max_wait, генерация уходит на запасной уровень
+    (fallback, быстрая модель) — при условии, что там ждать меньше.
+    Ожидаемое ожидание — большее из двух:
+    - p95 замеренного ожидания за последние horizon секунд (очередь задач
+      плюс ожидание слота уровня);
+    - прогноз по очереди: впереди queued задач и ждущие слота генерации,
+      обслуживаемые по concurrency одновременно, каждая — медиана замеренной
+      длительности (или tier.latency, пока замеров нет).
+    Уровень выбирается при постановке в очередь: от него зависит резерв кредитов.
+    """
+
+    def __init__(self, tiers, default, fallback, max_wait=30.0, horizon=120.0, window=200):
+        self.tiers = {tier.name: tier for tier in tiers}
+        self.default = self.tiers[default]
+        self.fallback = self.tiers[fallback]
+        self.max_wait = max_wait
+        self.horizon = horizon
+        self._states = {tier.name: _TierState(tier, window) for tier in tiers}
+
+    def get(self, name):
+        return self.tiers.get(name) if name else None
+
+    def expected_wait(self, tier, queued=0):
+        state = self._states[tier.name]
+        since = time.monotonic() - self.horizon
+        observed = percentile([wait for at, wait in state.waits if at >= since], 0.95) or 0.0
+        latency = percentile(state.latencies, 0.5) or tier.latency
+        predicted = (queued + state.waiting) * latency / tier.concurrency
+        return max(observed, predicted)
+
+    def choose(self, preferred=None, queued=0):
+        """(уровень, True — если переключились на запасной из-за ожидания)"""
+        tier = self.get(preferred) or self.default
+        fell_back = False
+        if tier is not self.fallback:
+            wait = self.expected_wait(tier, queued)
+            if wait > self.max_wait and self.expected_wait(self.fallback, queued) < wait:
+                self._states[tier.name].fallbacks += 1
+                TIER_FALLBACKS.inc(tier.name)
+                tier, fell_back = self.fallback, True
+        self._states[tier.name].selected += 1
+        GENERATION_TIER.inc(tier.name)
+        return tier, fell_back
+
+    @asynccontextmanager
+    async def slot(self, tier, waited=0.0):
+        """Слот генерации уровня; waited — сколько задача уже простояла в очереди"""
+        state = self._states[tier.name]
+        started = time.monotonic()
+        state.waiting += 1
+        try:
+            await state.semaphore.acquire()
+        finally:
+            state.waiting -= 1
+        acquired = time.monotonic()
+        wait = waited + acquired - started
+        state.waits.append((acquired, wait))
+        TIER_WAIT_SECONDS.observe(wait, tier.name)
+
+        state.in_flight += 1
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            state.in_flight -= 1
+            state.semaphore.release()
+            # Ошибки обычно быстрее успешной генерации — медиану по ним не считаем
+            if succeeded:
+                state.latencies.append(time.monotonic() - acquired)
+
+    def stats(self):
+        stats = {}
+        for name, tier in self.tiers.items():
+            state = self._states[name]
+            latency = percentile(state.latencies, 0.5)
+            stats[name] = {
+                "in_flight": state.in_flight,
+                "waiting": state.waiting,
+                "selected": state.selected,
+                "fallbacks": state.fallbacks,
+                "latency_p50": latency if latency is not None else tier.latency,
+                "expected_wait": self.expected_wait(tier),
+            }
+        return stats
@@ -0,0 +1,74 @@
+# usercache.py — кэш строк users в памяти процесса (LRU, write-through из Database)
+from collections import OrderedDict
+
+USER_FIELDS = ('id', 'balance', 'total_generations', 'preferred_tier')
+
+
+class UserCache:
+    """telegram_id -> {id, balance, total_generations, preferred_tier}.
+
+    Пишет только Database: каждая изменяющая операция кладёт сюда строку,
+    которую вернул RETURNING. Изменения из других процессов приходят
+    через LISTEN/NOTIFY и сбрасывают запись.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.enabled = True
+        self._items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, telegram_id):
+        if not self.enabled:
+            return None
+        row = self._items.get(telegram_id)
+        if row is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(telegram_id)
+        self.hits += 1
+        return row
+
+    def peek(self, telegram_id):
+        """Чтение без учёта в статистике и без изменения порядка LRU"""
+        return self._items.get(telegram_id) if self.enabled else None
+
+    def put(self, telegram_id, row):
+        """Полная строка из RETURNING: id, balance, total_generations, preferred_tier"""
+        if not self.enabled:
+            return
+        self._items[telegram_id] = {field: row[field] for field in USER_FIELDS}
+        self._items.move_to_end(telegram_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, telegram_id, **fields):
+        """Частичное обновление — только если строка уже в кэше"""
+        row = self._items.get(telegram_id)
+        if row is not None:
+            row.update(fields)
+
+    def invalidate(self, telegram_id):
+        if self._items.pop(telegram_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
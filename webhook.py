@@ -0,0 +1,98 @@
+# webhook.py — приём апдейтов через вебхук (aiohttp), несколько процессов на одном порту
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+def build_app(bot, dp, db, path, secret=None, replicate_client=None, replicate_path=None, ready=None):
+    """aiohttp-приложение: вебхук Telegram, колбэк Replicate, /healthz и /readyz.
+
+    /metrics здесь нет: порт вебхука публичный, метрики — на METRICS_PORT.
+    ready — asyncio.Event: /readyz отвечает 503, пока процесс не закончил запуск.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+
+    async def healthz(request):
+        return web.Response(text="ok")
+
+    async def readyz(request):
+        if ready is not None and not ready.is_set():
+            return web.Response(status=503, text="starting")
+        try:
+            if db.pool and await db.ping():
+                return web.Response(text="ready")
+        except Exception as e:
+            logger.warning(f"⚠️ readyz: БД недоступна: {e}")
+        return web.Response(status=503, text="not ready")
+
+    async def replicate_callback(request):
+        # Данным колбэка не доверяем: ожидающий сам перечитает предсказание через API
+        payload = await request.json()
+        replicate_client.notify(payload.get("id"))
+        return web.Response(text="ok")
+
+    if replicate_client and replicate_path:
+        app.router.add_post(replicate_path, replicate_callback)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    return app
+
+
+async def serve(app, bot, dp, host, port, reuse_port=False, webhook_url=None, secret=None, on_ready=None):
+    """Запуск HTTP-сервера до SIGTERM/SIGINT; on_ready() — когда порт слушается и вебхук зарегистрирован"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, reuse_port=reuse_port)
+    await site.start()
+    logger.info(f"🌐 Вебхук слушает {host}:{port}")
+
+    try:
+        if webhook_url:
+            await bot.set_webhook(
+                webhook_url,
+                secret_token=secret,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"✅ Вебхук зарегистрирован: {webhook_url}")
+        if on_ready:
+            on_ready()
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+        logger.info("🛑 Получен сигнал остановки")
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+def run_workers(target, workers):
+    """N процессов с SO_REUSEPORT на одном порту; target(worker_index) в каждом"""
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=target, args=(index,), name=f"webhook-worker-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"🚀 Запущено процессов вебхука: {workers}")
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    for process in processes:
+        process.join()